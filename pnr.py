@@ -1,23 +1,34 @@
 #!/usr/bin/env python
 
 import copy
+import io
 import logging
 import optparse
 import os
+import queue
+import signal
 import sys
+import threading
 import time
 
-from multiprocessing import Process, Lock, Queue, Condition
+from multiprocessing import Process, Queue, Pool
 
-from pnr_read import read_pnr
+from pnr_read import PnrDump, read_pnr_views, record_regnum, has_airline_segment
+from pnr_index import open_index, load_regnums
+from pnr_delta import load_fingerprints, changed_entries, deleted_regnums
 from pnr_parse import parse_pnr
-from pnr_telegram import make_telegram
-# from pnr_csv import make_csv
+from pnr_cache import ParsedCache, parse_cached
+from pnr_telegram import write_pnr
+from pnr_stats import count_drop, count_time, take_stats, add_stats, format_stats
+from pnr_profile import RecordTimer, add_record, take_slowest, add_slowest, format_slowest
+from pnr_log import kind, start_logging, stop_logging, send_counts
+from pnr_output import open_output, zstandard, COMPRESSIONS
+from pnr_csv import write_csv, write_headers
 
 from pnr_types import *
 
 
-def parse_opts():
+def parse_opts(args = None):
     parser = optparse.OptionParser()
 
     parser.add_option("-i", "--filename", dest = "filename",
@@ -45,8 +56,18 @@ def parse_opts():
     parser.add_option("-o", "--outfile", dest = "outfile", default = sys.stdout,
                       help = ("output file name"))
 
-    parser.add_option("-m", "--parallel", dest = "parallel", default = '1',
-                      help = ("run in parallel"))
+    parser.add_option("-z", "--compress", dest = "compress", default = None,
+                      help = ("compress output file, values [gzip, zstd]"))
+
+    parser.add_option("-m", "--parallel", dest = "parallel", default = 'auto',
+                      help = ("number of worker processes, 0 to run in the main process "
+                              "or `auto` to use all available cores. By default: auto"))
+
+    parser.add_option("-b", "--batch-size", dest = "batch_size", type = "int", default = None,
+                      help = ("records sent to a worker at once"))
+
+    parser.add_option("-c", "--chunked", dest = "chunked", action = "store_true", default = False,
+                      help = ("parallel workers read byte ranges of the file themselves"))
 
     parser.add_option("-l", "--local_systems", dest = "local_systems", default = None,
                       help = ("force local systems"))
@@ -54,7 +75,53 @@ def parse_opts():
     parser.add_option("-g", "--ignored_file", dest = "ignored", default = 'ignored.log',
                       help = ("ignored PNRs file"))
 
-    opts, args = parser.parse_args()
+    parser.add_option("--ssr-file", dest = "ssr_table", default = 'ssr.csv',
+                      help = ("SSR table file of csv format. By default: ssr.csv"))
+
+    parser.add_option("--osi-file", dest = "osi_table", default = 'osi.csv',
+                      help = ("OSI table file of csv format. By default: osi.csv"))
+
+    parser.add_option("-r", "--regnums", dest = "regnums", default = None,
+                      help = ("process only PNRs listed in file "
+                              "(one regnum per line or an ignored PNRs file)"))
+
+    parser.add_option("-k", "--skip", dest = "skip", type = "int", default = 0,
+                      help = ("skip the first `skip` records"))
+
+    parser.add_option("-t", "--resume-from", dest = "resume_from", default = None,
+                      help = ("start from the record with this regnum"))
+
+    parser.add_option("-P", "--profile", dest = "profile", type = "int", default = 0,
+                      help = ("time each PNR and report this many slowest of them"))
+
+    parser.add_option("--profile-file", dest = "profile_file", default = 'slow-pnr.log',
+                      help = ("slowest PNRs report file. By default: slow-pnr.log"))
+
+    parser.add_option("--log-level", dest = "log_level", default = 'DEBUG',
+                      help = ("lowest level of messages written to pnr-parse.log. "
+                              "By default: DEBUG"))
+
+    parser.add_option("--log-summary", dest = "log_summary", type = "int", default = 0,
+                      help = ("write only this many messages of each kind of failure "
+                              "and the number of the others at the end of the log"))
+
+    parser.add_option("--cache", dest = "cache", default = None,
+                      help = ("file of parsed PNRs kept between runs, records parsed "
+                              "before (with the same current year) are not parsed again"))
+
+    parser.add_option("--cache-size", dest = "cache_size", type = "int", default = 1024,
+                      help = ("size limit of the cache in megabytes, the least recently "
+                              "used PNRs are dropped above it. By default: 1024"))
+
+    parser.add_option("-D", "--delta", dest = "delta", default = None,
+                      help = ("previous dump or its index, only PNRs which are new or "
+                              "changed since it are processed"))
+
+    parser.add_option("--deleted-file", dest = "deleted", default = 'deleted.log',
+                      help = ("file of regnums of PNRs which are in the previous dump "
+                              "but not in this one. By default: deleted.log"))
+
+    opts, args = parser.parse_args(args)
 
     if not opts.filename:
         parser.error("You must specify a filename.")
@@ -68,156 +135,649 @@ def parse_opts():
     if opts.pred_point is None:
         opts.pred_point = opts.src_addr[0:3] + opts.src_addr[5:7]
 
-    if isinstance(opts.outfile, str):
-        opts.outfile = open(opts.outfile, 'w')
+    if opts.parallel == 'auto':
+        opts.parallel = available_cores()
+    elif opts.parallel.isdigit():
+        opts.parallel = int(opts.parallel)
+    else:
+        parser.error('Wrong `parallel`. Must be a number of workers or `auto`.')
 
-    if opts.parallel not in ('0', '1'):
-        parser.error('Wrong `parallel`. Must be 0 or 1.')
+    if opts.batch_size is not None and opts.batch_size < 1:
+        parser.error('Wrong `batch-size`. Must be positive.')
 
     if opts.format_ not in ('airimp', 'csv'):
         parser.error('Wrong `format`. Must be `airimp` or `csv`.')
 
+    if opts.compress not in (None,) + COMPRESSIONS:
+        parser.error('Wrong `compress`. Must be `gzip` or `zstd`.')
+
+    if opts.compress == 'zstd' and zstandard is None:
+        parser.error('`zstd` compression needs the zstandard package.')
+
+    if opts.regnums and (opts.skip or opts.resume_from):
+        parser.error('`regnums` can not be used with `skip` or `resume-from`.')
+
+    if opts.regnums and opts.chunked:
+        parser.error('`regnums` can not be used with `chunked`.')
+
+    if opts.delta and (opts.regnums or opts.chunked):
+        parser.error('`delta` can not be used with `regnums` or `chunked`.')
+
+    if opts.skip < 0:
+        parser.error('Wrong `skip`. Must be positive.')
+
+    if opts.profile < 0:
+        parser.error('Wrong `profile`. Must be positive.')
+
+    if opts.log_summary < 0:
+        parser.error('Wrong `log-summary`. Must be positive.')
+
+    if opts.cache_size < 1:
+        parser.error('Wrong `cache-size`. Must be positive.')
+
+    opts.log_level = opts.log_level.upper()
+    if not isinstance(logging.getLevelName(opts.log_level), int):
+        parser.error('Wrong `log-level`. Must be DEBUG, INFO, WARNING or ERROR.')
+
+    if opts.regnums:
+        opts.regnums = load_regnums(opts.regnums)
+
+    if opts.resume_from:
+        with open_index(opts.filename) as index:
+            try:
+                index.find(opts.resume_from)
+            except KeyError:
+                parser.error('Wrong `resume-from`. No PNR {0} in {1}.'.format(
+                    opts.resume_from, opts.filename))
+
     systems = opts.local_systems
     if systems:
         systems = systems.split(',')
         for system in systems:
             system = system.strip()
 
-    opts.parallel = True if opts.parallel == '1' else False
+    if opts.cache:
+        opts.cache = ParsedCache(opts.cache)
+
+    if opts.delta:
+        try:
+            opts.delta = load_fingerprints(opts.delta)
+        except (OSError, ValueError) as e:
+            parser.error('Wrong `delta`: {0}'.format(e))
+        opts.deleted = open_output(opts.deleted)
+    else:
+        opts.deleted = None
+
+    opts.outfile = open_output(opts.outfile, opts.compress)
 
     if isinstance(opts.ignored, str):
-        opts.ignored = open(opts.ignored, 'w')
+        opts.ignored = open_output(opts.ignored)
+
+    if opts.format_ == 'csv':
+        opts.ssr_table = open_output(opts.ssr_table)
+        opts.osi_table = open_output(opts.osi_table)
+        write_headers(opts)
+    else:
+        opts.ssr_table = opts.osi_table = None
 
     return opts
 
 
+def available_cores():
+    """
+    Number of cores the process is allowed to run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+BATCH_SIZE = 64
+
+
+def schedule(count, batch_size = None):
+    """
+    Queue size, batch size (in records) and reorder buffer size for
+    `count` workers. Queue and buffer sizes are in batches.
+
+    Two batches are kept ready for each worker, so none of them has to wait
+    for the reader while the others are busy. The reorder buffer holds
+    twice as many batches as may be queued or in work at once, so one slow
+    batch does not stop the others.
+    """
+    queue_size = count * 2
+
+    return queue_size, batch_size or BATCH_SIZE, 2 * (queue_size + count)
+
+
+MAIN_SEPARATOR = '!' * 80
+
+
+EXCEPTION_FORMAT = ("%s\n"
+                    "%s\n"
+                    "Main process exception.\n"
+                    "PNR: %s\nException: %s\n"
+                    "%s\n\n")
+
+
 def print_exception(record, text, e):
-    data = "{0}\n"
-    "{4}\n"
-    "Main process exception.\n"
-    "PNR: {1}\nException: {2}\n"
-    "{3}\n\n".format('!' * 80, record, e, '!' * 80, text)
+    args = (MAIN_SEPARATOR, text, '\n'.join(record), e, MAIN_SEPARATOR)
+
+    print(EXCEPTION_FORMAT % args, file = sys.stderr)
+    logging.error(EXCEPTION_FORMAT, *args)
+
+
+def prefilter(record, settings):
+    """
+    Reject raw `record` without parsing it if it has no segment of
+    `settings.airline`. Returns False if the record is rejected.
+
+    Rejected records are written to the ignored PNRs file the same way
+    `fix_not_allowed_airline` does.
+    """
+    if not settings.airline:
+        return True
+
+    start = time.perf_counter()
+    found = has_airline_segment(record, settings.airline)
+    regnum = None if found else record_regnum(record)
+    count_time('prefilter', time.perf_counter() - start)
+
+    if regnum is None:
+        # the segment is found or the record is broken and the parser complains
+        return True
+
+    count_drop('prefilter')
+
+    if settings.ignored:
+        settings.ignored.write('Regnum: {0} Reason: no "{1}" itin\n'.format(
+            regnum, settings.airline))
+
+    return False
+
+
+def write_telegram(record, settings, out):
+    """
+    Convert `record` and write its telegram followed by an empty line to
+    `out` (`io.StringIO`). Nothing is written for rejected PNRs.
+
+    With `settings.profile` the time of each stage is measured and the
+    record is kept if it is one of the slowest.
+    """
+    timer = RecordTimer() if settings.profile else None
 
-    print(data)
-    logging.error(data)
+    accepted = prefilter(record, settings)
 
+    if timer:
+        timer.lap('prefilter')
+        if not accepted:
+            add_record(timer, record_regnum, record, settings.profile)
+
+    if not accepted:
+        return
 
-def get_telegram(record, settings):
     try:
-        pnr = parse_pnr(record, settings)
+        if settings.cache:
+            pnr = parse_cached(record, settings, parse_pnr)
+        else:
+            pnr = parse_pnr(record, settings)
     except Exception as e:
         print_exception(record, 'PNR exception.', e)
         raise
 
+    if timer:
+        timer.lap('parse')
+
     try:
         if settings.format_ == 'airimp':
-            return make_telegram(pnr, settings)
+            start = out.tell()
+            if write_pnr(pnr, settings, out, timer) and out.tell() != start:
+                out.write('\n\n')
         else:
-            return make_csv(pnr, settings)
+            write_csv(pnr, settings, out)
+            if timer:
+                timer.lap('telegram')
     except Exception as e:
         print_exception(record, 'Telegram exception.', e)
         raise
 
-    return None
+    if timer:
+        add_record(timer, record_regnum, record, settings.profile)
+
+
+# settings attributes of the outputs other than telegrams (or segment rows),
+# workers write them to buffers of their own and send with the telegrams
+SIDE_OUTPUTS = ('ignored', 'ssr_table', 'osi_table')
+
+
+def side_buffers(settings):
+    """
+    Copy of `settings` with buffers in place of its side outputs.
+    """
+    s = copy.copy(settings)
+    for name in SIDE_OUTPUTS:
+        if getattr(settings, name, None):
+            setattr(s, name, io.StringIO())
+
+    return s
+
+
+def take_side_texts(settings):
+    """
+    Text of each side output buffer of `settings`, the buffers are emptied.
+    """
+    texts = []
+    for name in SIDE_OUTPUTS:
+        buf = getattr(settings, name, None)
+        texts.append(buf.getvalue() if buf else '')
+        if buf:
+            buf.seek(0)
+            buf.truncate()
+
+    return texts
+
+
+def write_side_texts(settings, texts):
+    for name, text in zip(SIDE_OUTPUTS, texts):
+        if text:
+            getattr(settings, name).write(text)
+
+
+def write_deleted(settings):
+    """
+    Write regnums of PNRs of the previous dump which are gone from this one.
+    Returns their number.
+    """
+    with open_index(settings.filename) as index:
+        regnums = deleted_regnums(index, settings.delta)
+
+    for regnum in regnums:
+        settings.deleted.write(regnum + '\n')
 
+    return len(regnums)
 
-def write_telegram(telegram, outfile):
-    if telegram:
-        outfile.write(telegram)
-        outfile.write('\n\n')
 
+def close_outputs(settings):
+    settings.outfile.close()
+    if getattr(settings, 'deleted', None):
+        settings.deleted.close()
+    for name in SIDE_OUTPUTS:
+        output = getattr(settings, name, None)
+        if output:
+            output.close()
 
-def process_pnr(q, num, settings, cond):
-    with open("parsed{}.txt".format(num), "w") as file,\
-         open("ignored{}.txt".format(num), "w") as ignored:
-            while True:
-                record = q.get()
 
-                if record is None:
-                    break
+def flush(out, outfile):
+    """
+    Move text of `out` buffer to `outfile` and empty the buffer for reuse.
+    """
+    outfile.write(out.getvalue())
+    out.seek(0)
+    out.truncate()
+
+
+def process_pnr(tasks, results, settings):
+    """
+    Worker process: converts batches of records from `tasks` and puts
+    telegrams, side outputs text, stage counters and the slowest records
+    of each batch to `results`.
+    """
+    init_worker_signals()
+
+    s = side_buffers(settings)
+    out = io.StringIO()
+
+    while True:
+        task = tasks.get()
+
+        if task is None:
+            if s.cache:
+                s.cache.close()
+            send_counts()
+            break
+
+        num, batch = task
+
+        for record in batch:
+            write_telegram(record, s, out)
+
+        results.put((num, out.getvalue(), take_side_texts(s), take_stats(), take_slowest()))
 
-                s = copy.copy(settings)
-                s.ignored = ignored
+        out.seek(0)
+        out.truncate()
 
-                write_telegram(get_telegram(record, s), file)
+
+def read_records(settings):
+    """
+    Yields records of `settings.filename` to process.
+
+    The record index is used when only some of the records are needed.
+    """
+    if settings.delta:
+        with open_index(settings.filename) as index:
+            for entry in changed_entries(index, settings.delta, first_record(index, settings)):
+                yield index.view(entry)
+        return
+
+    if not settings.regnums and not settings.skip and not settings.resume_from:
+        for record in read_pnr_views(settings.filename):
+            yield record
+        return
+
+    with open_index(settings.filename) as index:
+        if settings.regnums:
+            for regnum in settings.regnums:
+                try:
+                    yield index.by_regnum(regnum)
+                except KeyError:
+                    logging.warning("Unknown regnum: %s", regnum, extra = kind('unknown regnum'))
+            return
+
+        for record in index.records(first_record(index, settings)):
+            yield record
+
+
+def first_record(index, settings):
+    """
+    Number of the record to start with.
+    """
+    if settings.resume_from:
+        return index.find(settings.resume_from)
+
+    return settings.skip
+
+
+def first_record_offset(settings):
+    """
+    Byte offset of the record to start with or None if there is nothing to do.
+    """
+    if not settings.skip and not settings.resume_from:
+        return 0
+
+    with open_index(settings.filename) as index:
+        start = first_record(index, settings)
+        if start >= len(index):
+            return None
+
+        return index.entry(start).offset
 
 
 def start_current(settings):
     """
     Test function for single treaded process.
     """
-    for record in read_pnr(settings.filename):
-        write_telegram(get_telegram(record, settings), settings.outfile)
+    out = io.StringIO()
+
+    for num, record in enumerate(read_records(settings), 1):
+        write_telegram(record, settings, out)
+
+        if num % BATCH_SIZE == 0:
+            flush(out, settings.outfile)
+
+    flush(out, settings.outfile)
+
+
+def feed_batches(tasks, results, window, count, settings, batch_size):
+    """
+    Reader of `start_processes`: sends numbered batches of records to workers.
+
+    A batch is sent only when there is a room for it in the reorder buffer
+    (`window`). When done puts (None, batches count, error, None, None)
+    to `results`.
+    """
+    num = 0
+    error = None
+
+    try:
+        batch = []
+        for record in read_records(settings):
+            batch.append(record.lines())
+
+            if len(batch) == batch_size:
+                window.acquire()
+                tasks.put((num, batch))
+                num += 1
+                batch = []
+
+        if batch:
+            window.acquire()
+            tasks.put((num, batch))
+            num += 1
+    except Exception as e:
+        error = e
+    finally:
+        for ignore in range(count):
+            tasks.put(None)
+
+        results.put((None, num, error, None, None))
 
 
-def start_processes(count, settings, queue_size):
+def start_processes(count, settings, queue_size, batch_size, reorder_size):
     """
     Starts `count` processes for perform PNR data file `filename`.
 
-    `queue_size` - a queue size which contains readed PNR.
+    `queue_size` - a queue size which contains batches of readed PNR.
+    `batch_size` - number of PNR in a batch.
+    `reorder_size` - number of batches converted but not written yet.
+
+    Workers send results back and they are written in the records order.
     """
-    q = Queue(queue_size)
+    tasks = Queue(queue_size)
+    results = Queue()
+    window = threading.BoundedSemaphore(reorder_size)
     processes = []
-    cond = Condition()
 
     for num in range(count):
-        p = Process(target = process_pnr, args = (q, num, settings, cond))
+        p = Process(target = process_pnr, args = (tasks, results, settings))
         processes.append(p)
         p.daemon = True
         p.start()
 
-    for record in read_pnr(settings.filename):
-        q.put(record)
+    reader = threading.Thread(target = feed_batches,
+                              args = (tasks, results, window, count, settings, batch_size))
+    reader.daemon = True
+    reader.start()
 
-    for ignore in range(count):
-        q.put(None)
+    pending = {}
+    written = 0
+    total = None
+    error = None
 
-    q.close()
+    try:
+        while total is None or written < total:
+            try:
+                num, telegrams, sides, stats, slowest = results.get(timeout = 1)
+            except queue.Empty:
+                if any(p.exitcode for p in processes):
+                    raise RuntimeError('PNR worker process failed')
+                continue
+
+            if num is None:
+                total, error = telegrams, sides
+                continue
+
+            pending[num] = (telegrams, sides)
+            add_stats(stats)
+            add_slowest(slowest, settings.profile)
+
+            while written in pending:
+                telegrams, sides = pending.pop(written)
+                settings.outfile.write(telegrams)
+                write_side_texts(settings, sides)
+                written += 1
+                window.release()
+    except BaseException:
+        # nothing is read from the workers anymore, do not wait for them
+        tasks.cancel_join_thread()
+        for process in processes:
+            process.terminate()
+        raise
+
+    reader.join()
 
     for process in processes:
         process.join()
 
-    concat_files(settings.outfile, count, 'parsed')
-    concat_files(settings.ignored, count, 'ignored')
+    if error is not None:
+        raise error
 
 
-def concat_files(outfile, n, name):
-    files = []
-    for i in range(n):
-        files.append('{0}{1}.txt'.format(name, i))
+CHUNK_MIN_SIZE = 2 ** 16
+CHUNK_MAX_SIZE = 2 ** 23
 
-    for filename in files:
-        with open(filename, 'r') as fd:
-            for line in fd:
-                outfile.write(line)
+chunk_settings = None
+
+
+def init_chunk_worker(settings):
+    global chunk_settings
+    chunk_settings = settings
+
+    init_worker_signals()
 
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
 
+def process_chunk(chunk):
+    """
+    Read and convert records of byte range `chunk` of the PNR data file.
+
+    Returns telegrams, side outputs text, stage counters and the slowest
+    records of the range.
+    """
+    start, end = chunk
+
+    out = io.StringIO()
+    settings = side_buffers(chunk_settings)
+
+    with PnrDump(settings.filename) as dump:
+        for record in dump.records(start, end):
+            write_telegram(record, settings, out)
+
+    if settings.cache:
+        settings.cache.flush()
 
-def init_logging():
-    logging.basicConfig(format='%(asctime)s %(levelname)s:\n%(message)s',
-                        filename='pnr-parse.log',
-                        filemode='w',
-                        level=logging.DEBUG)
+    send_counts()
+
+    return out.getvalue(), take_side_texts(settings), take_stats(), take_slowest()
+
+
+def start_chunks(count, settings):
+    """
+    Starts `count` processes for perform PNR data file `filename`.
+
+    The file is cut into byte ranges on records boundaries and each process
+    reads its ranges itself. Results are written in the records order.
+    """
+    start = first_record_offset(settings)
+    if start is None:
+        return
+
+    with PnrDump(settings.filename) as dump:
+        chunk_size = (dump.limit - start) // (count * 4)
+        chunk_size = max(CHUNK_MIN_SIZE, min(CHUNK_MAX_SIZE, chunk_size))
+        chunks = dump.chunks(chunk_size, start)
+
+    pool = Pool(count, initializer = init_chunk_worker, initargs = (settings,))
+    try:
+        for telegrams, sides, stats, slowest in pool.imap(process_chunk, chunks):
+            settings.outfile.write(telegrams)
+            write_side_texts(settings, sides)
+            add_stats(stats)
+            add_slowest(slowest, settings.profile)
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+
+def init_logging(settings):
+    """
+    Log to pnr-parse.log through a queue, so worker processes do not
+    write to the file themselves.
+    """
+    return start_logging('pnr-parse.log', settings.log_level, settings.log_summary)
+
+
+def stop_on_signal(signum, frame):
+    """
+    Stop the conversion on SIGINT and SIGTERM the same way as on an error,
+    so the output files are written up and closed.
+    """
+    raise SystemExit('Stopped by signal {0}.'.format(signum))
+
+
+def init_worker_signals():
+    """
+    Workers leave stopping to the main process, which gets the same SIGINT,
+    and are killed by SIGTERM at once.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def report(settings, deleted, seconds):
+    """
+    Print the run report to stderr, stdout may be the output.
+    """
+    if deleted is not None:
+        print('Deleted PNRs: {0}.'.format(deleted), file = sys.stderr)
+
+    print('Execution time: {:.3} seconds.'.format(seconds), file = sys.stderr)
+
+    stats = format_stats()
+    if stats:
+        print(stats, file = sys.stderr)
+        logging.info('Stages:\n%s', stats)
+
+    if settings.profile:
+        print('Slowest PNRs are written to {0}'.format(settings.profile_file),
+              file = sys.stderr)
 
 
 def main():
     opts = parse_opts()
-    init_logging()
+    listener = init_logging(opts)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, stop_on_signal)
 
     start_time = time.time()
 
-    if opts.parallel:
-        start_processes(count = 3, settings = opts, queue_size = 500)
-    else:
-        start_current(opts)
+    try:
+        if opts.parallel and opts.chunked:
+            start_chunks(count = opts.parallel, settings = opts)
+        elif opts.parallel:
+            queue_size, batch_size, reorder_size = schedule(opts.parallel, opts.batch_size)
+            start_processes(count = opts.parallel, settings = opts,
+                            queue_size = queue_size, batch_size = batch_size,
+                            reorder_size = reorder_size)
+        else:
+            start_current(opts)
+
+        deleted = write_deleted(opts) if opts.delta else None
+
+        if opts.profile:
+            with open(opts.profile_file, 'w') as fh:
+                fh.write(format_slowest())
+
+        if opts.cache:
+            dropped = opts.cache.prune(opts.cache_size * 2 ** 20)
+            if dropped:
+                logging.info('Cache: %d least recently used PNRs dropped', dropped)
+
+        # the output (with the trailer of its compression) is complete
+        # before the reports, which go to stderr only
+        close_outputs(opts)
+
+        report(opts, deleted, time.time() - start_time)
+    finally:
+        if opts.cache:
+            opts.cache.close()
 
-    print('Execution time: {:.3} seconds.'.format(time.time() - start_time))
+        stop_logging(listener)
 
-    opts.outfile.close()
+        close_outputs(opts)
 
 
 if __name__ == "__main__":
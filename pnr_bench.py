@@ -0,0 +1,635 @@
+#!/usr/bin/env python
+"""
+Throughput benchmarks for PNR dump processing.
+
+Usage: ./pnr_bench.py [-i data | -x mix] [-s size_in_mb] [-r repeat] [-w workers]
+                      [-j results.json] [-c previous.json] [benchmark ...]
+
+Benchmarks: reader (default), scaling, elements, combine, memory, stages,
+columnar.
+
+The dump is the `-i` sample repeated or, with `-x`, synthetic records of
+the given mix, like `single=6,group=1,ssr=1,remarks=1,arnk=1`.
+"""
+
+import collections
+import io
+import itertools
+import json
+import logging
+import optparse
+import os
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+
+import pnr
+
+from pnr_read import read_pnr, read_pnr_views
+from pnr_parse import (GRAMMARS, PNR_OBJS, parse_raw_pnr, combine_fields, parse_pnr,
+                       init_raw_pnr)
+from pnr_types import Pnr, EMPTY, PnrParseException
+from pnr_telegram import fix_pnr, write_fixed_pnr
+from pnr_columnar import export_pnrs, load_pnrs
+
+
+def make_dump(source, filename, size):
+    """
+    Write `source` dump repeatedly to `filename` until it is `size` bytes.
+    """
+    with open(source, 'rb') as fh:
+        data = fh.read()
+
+    with open(filename, 'wb') as fh:
+        written = 0
+        while written < size:
+            fh.write(data)
+            written += len(data)
+
+    return filename
+
+
+SURNAMES = ('IVANOV', 'PETROVA', 'HOULE', 'NAKAJO', 'SMIRNOV', 'KUZNETSOVA',
+            'MESHCHANINTSEVA', 'TAKENOUCHI', 'ALIEV', 'RUSSELL')
+NAMES = ('IGOR MR', 'ANNA MRS', 'LANCE M MR', 'SORA MR', 'VIKA MS', 'ELDAR MR')
+CITIES = ('UUS', 'NRT', 'CTS', 'OHH', 'DEE', 'BVV', 'YVR', 'NGK', 'KHV')
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+DAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+RECORD_KINDS = ('single', 'group', 'ssr', 'remarks', 'arnk')
+
+DEFAULT_MIX = 'single=6,group=1,ssr=1,remarks=1,arnk=1'
+
+
+def parse_mix(text):
+    """
+    {kind: weight} from `single=6,group=1`. Raises ValueError.
+    """
+    mix = {}
+    for item in text.split(','):
+        kind, ignore, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in RECORD_KINDS:
+            raise ValueError('unknown record kind: {0}'.format(kind))
+        mix[kind] = int(weight or 1)
+
+    return mix
+
+
+def synthetic_record(kind, regnum, rnd):
+    """
+    Lines of a synthetic record of `kind` in the dump format:
+
+    single - one passenger with a DOCS, FOID and ticket SSRs;
+    group - a group of 20-60 passengers with the same SSRs each;
+    ssr - three passengers with 60 SSRs each;
+    remarks - one passenger with 15 long remarks;
+    arnk - one passenger with ARNK and OPEN segments.
+    """
+    lines = []
+    num = [1]
+
+    def add(code, text):
+        lines.append('{0} {1:>3}.{2}'.format(code, num[0], text))
+        num[0] += 1
+
+
+    def date():
+        return '{0:02d}{1}'.format(rnd.randint(1, 28), rnd.choice(MONTHS))
+
+
+    def names_line(first, paxes):
+        rest = ['{0}.{1}'.format(first + i, pax) for i, pax in enumerate(paxes[1:], 1)]
+        return ' '.join(['03 {0:>3}.{1}'.format(first, paxes[0])] + rest)
+
+
+    npax = {'group': rnd.randint(20, 60), 'ssr': 3}.get(kind, 1)
+    paxes = ['{0}/{1}'.format(rnd.choice(SURNAMES), rnd.choice(NAMES)) for ignore in range(npax)]
+
+    if kind == 'group':
+        lines.append('02   0.{0}GROUP{1}/GRP NM{0} {2}'.format(
+            npax, rnd.randint(1, 99), regnum))
+        for first in range(0, npax, 4):
+            lines.append(names_line(first + 1, paxes[first:first + 4]))
+    else:
+        lines.append(names_line(1, paxes) + ' ' + regnum)
+    num[0] += npax
+
+    segments = []
+    for ignore in range(rnd.randint(1, 4)):
+        segment = (rnd.choice(('HZ', 'HZ', 'HZ', 'AC', 'JL')),
+                   str(rnd.randint(1, 9999)),
+                   rnd.choice('YCMGT'),
+                   rnd.choice(DAYS) + date(),
+                   ''.join(rnd.sample(CITIES, 2)))
+        segments.append(segment)
+        add('04', '   {0} {1:<4} {2}   {3}  {4} {5:<5} {6:02d}{7:02d} {8:02d}{9:02d}'.format(
+            *(segment + ('HK{0}'.format(npax),
+                         rnd.randint(0, 23), rnd.randint(0, 59),
+                         rnd.randint(0, 23), rnd.randint(0, 59)))))
+
+    if kind == 'arnk':
+        add('04', '   ARNK')
+        add('04', '   HZ OPEN Y        {0}'.format(''.join(rnd.sample(CITIES, 2))))
+
+    if kind == 'group':
+        add('05', 'BKD {0} CNL 0 SPLIT 0'.format(npax))
+
+    add('06', str(rnd.randint(10 ** 10, 10 ** 11)))
+    add('07', 'T/ *T')
+
+    nssr = 30 if kind == 'ssr' else 1
+    for paxnum, pax in enumerate(paxes, 1):
+        surname, name = pax.split('/')
+        for ignore in range(nssr):
+            add('13', 'SSR DOCS HZ  HK1 /P/RU/{0}/RU/{1}{2:02d}/M//{3}/{4}'.format(
+                rnd.randint(10 ** 9, 10 ** 10), date(), rnd.randint(50, 99),
+                surname, name.split()[0]))
+            lines.append('13      /P{0}'.format(paxnum))
+            add('13', 'SSR FOID HZ  HK1 PP{0}/P{1}'.format(rnd.randint(10 ** 9, 10 ** 10), paxnum))
+
+        ticket = rnd.randint(10 ** 12, 10 ** 13)
+        for coupon, (airline, flight, itin_class, depdate, cities) in enumerate(segments, 1):
+            add('13', 'SSR TKNE {0}  HK1 {1}{2:0>4}{3}{4}.{5}C{6}/P{7}'.format(
+                airline, cities, flight, itin_class, depdate[2:], ticket, coupon, paxnum))
+
+    add('14', 'OSI YY  CTCP {0}'.format(rnd.randint(10 ** 10, 10 ** 11)))
+
+    for ignore in range(15 if kind == 'remarks' else 1):
+        words = ' '.join(rnd.choice(SURNAMES) for ignore in range(rnd.randint(3, 20)))
+        add('15', 'ETA I {0}14 {1} {2}/P1'.format(date(), ''.join(rnd.sample(CITIES, 2)), words))
+
+    office = rnd.choice(CITIES) + '00' + str(rnd.randint(1, 9))
+    add('31', '{0}//{1}/HZ/A/RU'.format(office, office[:3]))
+
+    return lines
+
+
+def make_synthetic_dump(filename, size, mix, seed = 2014):
+    """
+    Write synthetic records of `mix` ({kind: weight}) to `filename` until
+    it is `size` bytes. The same seed gives the same dump.
+    """
+    rnd = random.Random(seed)
+    kinds = sorted(mix)
+    weights = [mix[kind] for kind in kinds]
+
+    count = 0
+    written = 0
+    with open(filename, 'w') as fh:
+        while written < size:
+            regnum = 'T{0:04X}'.format(count % 2 ** 16)
+            text = '\n'.join(synthetic_record(rnd.choices(kinds, weights)[0], regnum, rnd))
+            text += '\n\n****End of PNR Key     {0}\n\n'.format(regnum)
+            fh.write(text)
+            written += len(text)
+            count += 1
+
+        fh.write('Total number of PNRs procesed: {0}\n'.format(count))
+
+    return count
+
+
+def best_time(fn, repeat, setup = None):
+    """
+    Best wall time of `repeat` runs of `fn` and its last result.
+
+    With `setup` each run is `fn(setup())`, setup is not timed.
+    """
+    best = None
+    result = None
+    for ignore in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, result
+
+
+def peak_memory(fn, *args):
+    """
+    Peak of memory allocated while `fn(*args)` runs.
+    """
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# name: {records_per_s, mb_per_s[, peak_mb]} of reported benchmarks
+RESULTS = collections.OrderedDict()
+
+
+def report(name, elapsed, count, nbytes, peak = None):
+    result = RESULTS[name] = {'records_per_s': count / elapsed,
+                              'mb_per_s': nbytes / elapsed / 2 ** 20}
+
+    line = '{0:<28} {1:>10.0f} records/s {2:>8.1f} MB/s'.format(
+        name, result['records_per_s'], result['mb_per_s'])
+
+    if peak is not None:
+        result['peak_mb'] = peak / 2 ** 20
+        line += ' {0:>8.1f} MB peak'.format(result['peak_mb'])
+
+    print(line)
+
+
+def bench_reader(filename, repeat):
+    """
+    Compare `read_pnr` and `read_pnr_views` on `filename`.
+    """
+    def lines():
+        return sum(1 for record in read_pnr(filename))
+
+    def views():
+        return sum(1 for record in read_pnr_views(filename))
+
+    def views_decoded():
+        return sum(1 for record in read_pnr_views(filename) if record.lines() is not None)
+
+    nbytes = os.path.getsize(filename)
+
+    for name, fn in (('read_pnr', lines),
+                     ('read_pnr_views', views),
+                     ('read_pnr_views (decoded)', views_decoded)):
+        elapsed, count = best_time(fn, repeat)
+        report(name, elapsed, count, nbytes)
+
+
+def bench_scaling(filename, repeat, workers):
+    """
+    Records/s of pnr.py parallel modes for 1, 2, 4, ... `workers` workers.
+    """
+    def run(count, chunked):
+        settings = bench_settings(filename, '-m', str(count), *(['-c'] if chunked else []))
+
+        try:
+            if chunked:
+                pnr.start_chunks(count, settings)
+            else:
+                pnr.start_processes(count, settings, *pnr.schedule(count))
+        finally:
+            settings.outfile.close()
+            settings.ignored.close()
+
+    nrecords = sum(1 for record in read_pnr_views(filename))
+    nbytes = os.path.getsize(filename)
+
+    counts = []
+    count = 1
+    while count < workers:
+        counts.append(count)
+        count *= 2
+    counts.append(workers)
+
+    for count in counts:
+        for chunked in (False, True):
+            elapsed, ignore = best_time(lambda: run(count, chunked), repeat)
+            name = '{0} x {1}'.format('chunked' if chunked else 'queue', count)
+            report(name, elapsed, nrecords, nbytes)
+
+
+# grammar, raw pnr field
+ELEMENTS = (
+    ("group", "group_name"),
+    ("pax", "name"),
+    ("itin", "segment"),
+    ("ssr", "ssr"),
+    ("osi", "osi"),
+    ("remarks", "remarks"),
+    ("endorsement", "endorsement_information"),
+    ("auxiliary", "auxiliary_service"),
+)
+
+
+def bench_settings(filename, *args):
+    return pnr.parse_opts(['-i', filename, '-o', os.devnull, '-g', os.devnull] + list(args))
+
+
+def bench_elements(filename, repeat, nrecords = 2000):
+    """
+    Per element cost of each element grammar: `re.search` with a pattern
+    string (module cache lookup), precompiled grammar and the whole parser.
+    """
+    settings = bench_settings(filename)
+
+    elements = collections.defaultdict(list)
+    for record in itertools.islice(read_pnr_views(filename), nrecords):
+        raw_pnr = parse_raw_pnr(record)
+        for grammar, field in ELEMENTS:
+            elements[grammar].extend((text, raw_pnr) for text in raw_pnr[field])
+
+    print('{0:<12} {1:>8} {2:>12} {3:>12} {4:>12}'.format(
+        'element', 'count', 're.search', 'compiled', 'parser'))
+
+    for grammar, field in ELEMENTS:
+        items = elements[grammar]
+        if not items:
+            continue
+
+        rx = GRAMMARS[grammar]
+        pattern = rx.pattern
+        fn = PNR_OBJS[field].fn
+
+        def before():
+            for text, raw_pnr in items:
+                re.search(pattern, text)
+
+        def after():
+            for text, raw_pnr in items:
+                rx.search(text)
+
+        def parser():
+            for text, raw_pnr in items:
+                try:
+                    fn(text, raw_pnr, settings)
+                except Exception:
+                    pass
+
+        times = [best_time(f, repeat)[0] / len(items) * 1e9 for f in (before, after, parser)]
+        print('{0:<12} {1:>8} {2:>9.0f} ns {3:>9.0f} ns {4:>9.0f} ns'.format(
+            grammar, len(items), *times))
+
+
+def heavy_record(nssr = 200, nremarks = 200):
+    """
+    Record with many SSR and remarks elements, some of them continued.
+    """
+    record = ['03   1.HOULE/LANCE M MR T02XL',
+              '04   2.   HZ 9234 C   TU10JUN  NRTUUS HK1   1630 2100']
+
+    num = 3
+    for i in range(nssr):
+        record.append('13 {0:>3}.SSR DOCS HZ  HK1 /P/RU/6401175922/RU/08JUN74/F//HOULE/'.format(num))
+        record.append('13      LANCE/P1')
+        num += 1
+
+    for i in range(nremarks):
+        record.append('15 {0:>3}.ETA I 10JUN14 NRTUUS 5554830283022C1/P1'.format(num))
+        num += 1
+
+    record.append('31 {0:>3}.HDQ1S /MOHVEI/8WN4/61734934'.format(num))
+
+    return record
+
+
+def bench_combine(repeat, nrecords = 200):
+    """
+    Lines/s of `combine_fields` on records with many SSR and remarks.
+    """
+    record = heavy_record()
+
+    def run():
+        for ignore in range(nrecords):
+            combine_fields(record)
+
+    elapsed, ignore = best_time(run, repeat)
+    nlines = len(record) * nrecords
+    print('{0:<28} {1:>10.0f} lines/s {2:>8.1f} us/record'.format(
+        'combine_fields', nlines / elapsed, elapsed / nrecords * 1e6))
+
+
+def traced_size(fn, items):
+    """
+    Bytes allocated and still kept by the results of `fn` for each of `items`.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = [fn(item) for item in items]
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    return size, kept
+
+
+def bench_memory(filename, nrecords = 2000):
+    """
+    Bytes per parsed PNR kept in memory: a dict with a list for each element
+    (as `collect_pnr` used to give) and `Pnr`. Parsed elements are shared by
+    both, so only the PNR containers are measured.
+    """
+    settings = bench_settings(filename)
+    pnrs = [parse_pnr(record, settings)
+            for record in itertools.islice(read_pnr_views(filename), nrecords)]
+
+    # parse all elements before measuring, only the containers are compared
+    for pnr in pnrs:
+        pnr.items()
+
+    def as_dict(pnr):
+        d = init_raw_pnr()
+        for key, value in pnr.items():
+            if value is not EMPTY:
+                d[key] = value
+        return d
+
+
+    def as_pnr(pnr):
+        p = Pnr()
+        for key, value in pnr.items():
+            p[key] = value
+        return p
+
+
+    for name, fn in (('dict', as_dict), ('Pnr', as_pnr)):
+        size, kept = traced_size(fn, pnrs)
+        print('{0:<28} {1:>10.0f} bytes/PNR'.format(name, size / len(kept)))
+
+
+def bench_stages(filename, repeat):
+    """
+    Records/s, MB/s and peak memory of each processing stage on its own:
+    reading, parsing (all fields), fixing and writing of telegrams.
+    """
+    settings = bench_settings(filename)
+    nbytes = os.path.getsize(filename)
+    records = list(read_pnr(filename))
+
+    def read():
+        return list(read_pnr(filename))
+
+    def parse():
+        pnrs = [parse_pnr(record, settings) for record in records]
+        for p in pnrs:
+            p.items()
+        return pnrs
+
+    def fix(pnrs):
+        fixed = []
+        for p in pnrs:
+            try:
+                p, ignore = fix_pnr(p, settings)
+            except PnrParseException:
+                continue
+            if p:
+                fixed.append(p)
+        return fixed
+
+    def telegrams(pnrs):
+        out = io.StringIO()
+        for p in pnrs:
+            write_fixed_pnr(p, settings, out)
+        return pnrs
+
+    fixed = fix(parse())
+
+    for name, fn, setup, args in (('read', read, None, ()),
+                                  ('parse', parse, None, ()),
+                                  ('fix', fix, parse, (parse(),)),
+                                  ('telegrams', telegrams, lambda: fixed, (fixed,))):
+        elapsed, ignore = best_time(fn, repeat, setup)
+        report(name, elapsed, len(records), nbytes, peak_memory(fn, *args))
+
+
+def bench_columnar(filename, repeat):
+    """
+    Records/s of the columnar export and of loading it back against
+    parsing the dump again.
+    """
+    settings = bench_settings(filename)
+    nbytes = os.path.getsize(filename)
+    dirname = tempfile.mkdtemp(prefix = 'pnr-bench-')
+
+    def reparse():
+        pnrs = [parse_pnr(record, settings) for record in read_pnr_views(filename)]
+        for p in pnrs:
+            p.items()
+        return len(pnrs)
+
+    try:
+        for name, fn in (('columnar export',
+                          lambda: export_pnrs(read_pnr_views(filename), dirname, settings)),
+                         ('columnar load', lambda: len(load_pnrs(dirname))),
+                         ('parse again', reparse)):
+            elapsed, count = best_time(fn, repeat)
+            report(name, elapsed, count, nbytes)
+    finally:
+        for name in os.listdir(dirname):
+            os.remove(os.path.join(dirname, name))
+        os.rmdir(dirname)
+
+
+def compare_results(filename):
+    """
+    Print changes of the results against the ones saved in `filename`.
+    """
+    with open(filename, 'r') as fh:
+        previous = json.load(fh)['results']
+
+    print('\n{0:<28} {1:>10} {2:>10} {3:>8}'.format('compared to ' + filename[-16:],
+                                                   'before', 'now', 'change'))
+
+    for name, result in RESULTS.items():
+        if name not in previous:
+            continue
+
+        for key in sorted(result):
+            before = previous[name].get(key)
+            if not before:
+                continue
+            print('{0:<28} {1:>10.1f} {2:>10.1f} {3:>+7.1f}%'.format(
+                '{0} {1}'.format(name, key), before, result[key],
+                (result[key] / before - 1) * 100))
+
+
+def save_results(filename, opts):
+    with open(filename, 'w') as fh:
+        json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'dump': opts.mix or opts.filename,
+                   'size_mb': opts.size,
+                   'results': RESULTS}, fh, indent = 2)
+
+
+BENCHMARKS = {
+    'reader': lambda opts, filename: bench_reader(filename, opts.repeat),
+    'scaling': lambda opts, filename: bench_scaling(filename, opts.repeat, opts.workers),
+    'elements': lambda opts, filename: bench_elements(filename, opts.repeat),
+    'combine': lambda opts, filename: bench_combine(opts.repeat),
+    'memory': lambda opts, filename: bench_memory(filename),
+    'stages': lambda opts, filename: bench_stages(filename, opts.repeat),
+    'columnar': lambda opts, filename: bench_columnar(filename, opts.repeat),
+}
+
+
+def parse_opts():
+    parser = optparse.OptionParser()
+
+    parser.add_option("-i", "--filename", dest = "filename", default = 'data',
+                      help = ("sample dump to repeat. By default: data"))
+
+    parser.add_option("-s", "--size", dest = "size", type = "int", default = 64,
+                      help = ("benchmark dump size in megabytes. By default: 64"))
+
+    parser.add_option("-r", "--repeat", dest = "repeat", type = "int", default = 3,
+                      help = ("runs of each benchmark, the best is reported"))
+
+    parser.add_option("-w", "--workers", dest = "workers", type = "int",
+                      default = pnr.available_cores(),
+                      help = ("maximum number of workers for scaling benchmark. "
+                              "By default: all available cores"))
+
+    parser.add_option("-x", "--mix", dest = "mix", default = None,
+                      help = ("use synthetic records of the given kinds and weights "
+                              "instead of the sample, like {0}".format(DEFAULT_MIX)))
+
+    parser.add_option("-j", "--json", dest = "json", default = None,
+                      help = ("save results to the given JSON file"))
+
+    parser.add_option("-c", "--compare", dest = "compare", default = None,
+                      help = ("compare results with the ones saved in the given JSON file"))
+
+    opts, args = parser.parse_args()
+
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark: {0}'.format(name))
+
+    if opts.mix:
+        try:
+            opts.mix_weights = parse_mix(opts.mix)
+        except ValueError as e:
+            parser.error('Wrong mix: {0}'.format(e))
+
+    opts.benchmarks = args or ['reader']
+
+    return opts
+
+
+def main():
+    opts = parse_opts()
+
+    fd, filename = tempfile.mkstemp(prefix = 'pnr-bench-')
+    os.close(fd)
+
+    logging.basicConfig(filename = os.devnull, level = logging.DEBUG)
+
+    try:
+        if opts.mix:
+            make_synthetic_dump(filename, opts.size * 2 ** 20, opts.mix_weights)
+        else:
+            make_dump(opts.filename, filename, opts.size * 2 ** 20)
+
+        for name in opts.benchmarks:
+            BENCHMARKS[name](opts, filename)
+    finally:
+        os.remove(filename)
+
+    if opts.compare:
+        compare_results(opts.compare)
+
+    if opts.json:
+        save_results(opts.json, opts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+On-disk cache of parsed PNRs.
+
+Parsed elements depend on the record text and `current_year` only, so they
+are kept in an SQLite file under a hash of both and later runs (with other
+airline, addresses and so on) take them from there instead of parsing.
+
+Each process opens the file itself. New entries and the use times of the
+found ones are written in batches. `prune` drops the least recently used
+entries when the file holds more than its limit.
+"""
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+from pnr_types import *
+
+
+# change when parsed PNRs change, entries of other versions are not used
+VERSION = b'1'
+
+# entries and use times written at once
+BATCH_SIZE = 256
+
+SCHEMA = """
+create table if not exists parsed (
+    key blob primary key,
+    used integer not null,
+    size integer not null,
+    value blob not null
+)
+"""
+
+
+def record_key(lines, current_year):
+    """
+    Hash of record `lines` and `current_year`.
+    """
+    h = hashlib.blake2b(VERSION, digest_size = 16)
+    h.update(str(current_year).encode('utf-8'))
+    h.update(b'\n')
+    h.update('\n'.join(lines).encode('utf-8'))
+
+    return h.digest()
+
+
+def dump_pnr(pnr):
+    return zlib.compress(pickle.dumps(tuple(pnr.items()), pickle.HIGHEST_PROTOCOL), 1)
+
+
+def load_pnr(value):
+    pnr = Pnr()
+    for key, element in pickle.loads(zlib.decompress(value)):
+        setattr(pnr, key, element)
+
+    return pnr
+
+
+class ParsedCache(object):
+    """
+    Parsed PNRs in SQLite file `filename`.
+
+    An instance may be copied to forked processes, each of them opens its
+    own connection on first use.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = None
+        self.db = None
+        self.new = []
+        self.used = []
+
+
+    def connect(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.new = []
+            self.used = []
+            self.db = sqlite3.connect(self.filename, timeout = 60)
+            self.db.execute('pragma journal_mode = wal')
+            self.db.execute(SCHEMA)
+
+        return self.db
+
+
+    def get(self, key):
+        """
+        PNR parsed from the record with `key` or None.
+        """
+        row = self.connect().execute('select value from parsed where key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        self.used.append(key)
+        if len(self.used) >= BATCH_SIZE:
+            self.flush()
+
+        return load_pnr(row[0])
+
+
+    def put(self, key, pnr):
+        """
+        Keep fully parsed `pnr`. It must be stored before fixes change it.
+        """
+        value = dump_pnr(pnr)
+        self.new.append((key, int(time.time()), len(value), value))
+        if len(self.new) >= BATCH_SIZE:
+            self.flush()
+
+
+    def flush(self):
+        if self.pid != os.getpid() or not (self.new or self.used):
+            return
+
+        now = int(time.time())
+        with self.db:
+            self.db.executemany('insert or replace into parsed values (?, ?, ?, ?)', self.new)
+            self.db.executemany('update parsed set used = ? where key = ?',
+                                [(now, key) for key in self.used])
+
+        self.new = []
+        self.used = []
+
+
+    def prune(self, limit):
+        """
+        Drop the least recently used entries until they take at most
+        `limit` bytes. Returns the number of entries dropped.
+        """
+        db = self.connect()
+        self.flush()
+
+        total = db.execute('select coalesce(sum(size), 0) from parsed').fetchone()[0]
+        if total <= limit:
+            return 0
+
+        keys = []
+        for key, size in db.execute('select key, size from parsed order by used'):
+            if total <= limit:
+                break
+            keys.append((key,))
+            total -= size
+
+        with db:
+            db.executemany('delete from parsed where key = ?', keys)
+
+        return len(keys)
+
+
+    def close(self):
+        self.flush()
+
+        if self.pid == os.getpid():
+            self.db.close()
+        self.pid = None
+        self.db = None
+
+
+def parse_cached(record, settings, parse):
+    """
+    `parse(record, settings)` or the PNR parsed from the same record before.
+
+    All elements of a new PNR are parsed to be stored, so their warnings
+    are logged by the run which parses the record only.
+    """
+    cache = settings.cache
+    key = record_key(record, settings.current_year)
+
+    pnr = cache.get(key)
+    if pnr is not None:
+        return pnr
+
+    pnr = parse(record, settings)
+    try:
+        pnr.items()
+    except PnrParseException:
+        # elements left are parsed again and fail the usual way
+        return pnr
+
+    cache.put(key, pnr)
+
+    return pnr
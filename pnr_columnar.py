@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+"""
+Columnar export of parsed PNRs.
+
+PNRs are saved as tables of typed columns, so reports can load them back
+(`load_pnrs`) instead of parsing the dump again:
+
+pnrs - regnum of each PNR;
+names, segments, ssr, osi, remarks - a row for each element, `pnr` is
+the number of its PNR in the `pnrs` table.
+
+Dates are day numbers, airline, status, city and other short codes are
+dictionary encoded. Rows are written in groups of `ROW_GROUP_SIZE`.
+With pyarrow installed each table is a Parquet file `<table>.parquet`,
+else a file `<table>.col` of `array` buffers (see `write_row_group`).
+
+Usage: ./pnr_columnar.py [-y current_year] dump directory
+"""
+
+import array
+import datetime
+import functools
+import gc
+import itertools
+import json
+import logging
+import optparse
+import os
+import struct
+import sys
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from pnr_read import read_pnr_views
+from pnr_parse import parse_pnr
+from pnr_types import *
+
+
+log = logging.getLogger(__name__)
+
+
+# table: PNR key of its elements, their type
+ELEMENT_TABLES = (
+    ('names', 'name', Pax),
+    ('segments', 'segment', Itin),
+    ('ssr', 'ssr', Ssr),
+    ('osi', 'osi', Osi),
+    ('remarks', 'remarks', Remarks),
+)
+
+# column kinds other than `str` (UTF-8 text): `int`, `bool`, `date` (days
+# since 1970-01-01) and `code` (dictionary encoded text)
+KINDS = {
+    'pnr': 'int',
+    'status': 'code',
+    'nseats': 'code',
+    'group': 'bool',
+    'airline': 'code',
+    'itin_class': 'code',
+    'depdate': 'date',
+    'deppoint': 'code',
+    'arrpoint': 'code',
+    'code': 'code',
+    'paxnum': 'code',
+}
+
+# kinds of the columns which differ from the ones of the same name
+TABLE_KINDS = {
+    ('names', 'nseats'): 'int',
+}
+
+# table: ((column, kind), ...)
+TABLES = [('pnrs', (('regnum', 'str'),))] + [
+    (table, tuple((column, TABLE_KINDS.get((table, column), KINDS.get(column, 'str')))
+                  for column in ('pnr',) + type_._fields))
+    for table, key, type_ in ELEMENT_TABLES]
+
+ROW_GROUP_SIZE = 2 ** 16
+
+MAGIC = b'PNRCOL1\n'
+
+# row group header size
+HEADER = struct.Struct('<I')
+
+# None of `int` and `date` columns
+NULL = -2 ** 31
+
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+def encode_column(kind, values):
+    """
+    Header of column `values` and its buffers.
+    """
+    if kind == 'code':
+        dictionary = {}
+        codes = array.array('I', [dictionary.setdefault(v, len(dictionary)) for v in values])
+        return {'kind': kind, 'dictionary': list(dictionary)}, [codes]
+
+    if kind == 'str':
+        data = [None if v is None else v.encode('utf-8') for v in values]
+        lengths = array.array('i', [-1 if v is None else len(v) for v in data])
+        return {'kind': kind}, [lengths, array.array('B', b''.join(v for v in data if v))]
+
+    if kind == 'date':
+        values = [NULL if v is None else v.toordinal() - EPOCH for v in values]
+    elif kind == 'bool':
+        return {'kind': kind}, [array.array('b', [-1 if v is None else int(v) for v in values])]
+    else:
+        values = [NULL if v is None else v for v in values]
+
+    return {'kind': kind}, [array.array('i', values)]
+
+
+def decode_column(header, buffers):
+    kind = header['kind']
+
+    if kind == 'code':
+        dictionary = header['dictionary']
+        return [dictionary[i] for i in buffers[0]]
+
+    if kind == 'str':
+        lengths, data = buffers
+        data = data.tobytes()
+        values = []
+        pos = 0
+        for length in lengths:
+            if length < 0:
+                values.append(None)
+            else:
+                values.append(data[pos:pos + length].decode('utf-8'))
+                pos += length
+        return values
+
+    if kind == 'bool':
+        return [None if v < 0 else bool(v) for v in buffers[0]]
+
+    if kind == 'date':
+        fromordinal = datetime.date.fromordinal
+        return [None if v == NULL else fromordinal(v + EPOCH) for v in buffers[0]]
+
+    return [None if v == NULL else v for v in buffers[0]]
+
+
+BUFFER_TYPES = {'code': ('I',), 'str': ('i', 'B'), 'bool': ('b',), 'date': ('i',), 'int': ('i',)}
+
+
+def write_row_group(fh, columns, values):
+    """
+    A row group is a header (JSON of the rows count, byte order and for
+    each column its kind, buffer sizes and dictionary) and the column
+    buffers one after another.
+    """
+    headers = []
+    buffers = []
+    for (column, kind), column_values in zip(columns, values):
+        header, column_buffers = encode_column(kind, column_values)
+        header['sizes'] = [len(buf) for buf in column_buffers]
+        headers.append(header)
+        buffers.extend(column_buffers)
+
+    header = json.dumps({'rows': len(values[0]),
+                         'byteorder': sys.byteorder,
+                         'columns': headers}).encode('utf-8')
+
+    fh.write(HEADER.pack(len(header)))
+    fh.write(header)
+    for buf in buffers:
+        buf.tofile(fh)
+
+
+def read_row_groups(fh, columns):
+    """
+    Yields {column: values} of each row group of a `.col` file.
+    """
+    if fh.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a columnar file: '{0}'".format(fh.name))
+
+    while True:
+        size = fh.read(HEADER.size)
+        if not size:
+            return
+
+        group = json.loads(fh.read(HEADER.unpack(size)[0]).decode('utf-8'))
+
+        values = {}
+        for (column, kind), header in zip(columns, group['columns']):
+            buffers = []
+            for typecode, size in zip(BUFFER_TYPES[kind], header['sizes']):
+                buf = array.array(typecode)
+                buf.fromfile(fh, size)
+                if group['byteorder'] != sys.byteorder:
+                    buf.byteswap()
+                buffers.append(buf)
+            values[column] = decode_column(header, buffers)
+
+        yield values
+
+
+ARROW_TYPES = {'int': 'int32', 'bool': 'bool_', 'date': 'date32', 'str': 'string', 'code': 'string'}
+
+
+class TableWriter(object):
+    """
+    Rows of a table, written to `filename` in groups of `row_group_size`.
+    """
+    def __init__(self, filename, columns, row_group_size = ROW_GROUP_SIZE):
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.values = [[] for column in columns]
+        self.appends = [values.append for values in self.values]
+        self.rows = 0
+
+        if pyarrow:
+            self.fh = None
+            self.schema = pyarrow.schema([(column, getattr(pyarrow, ARROW_TYPES[kind])())
+                                          for column, kind in columns])
+            self.writer = pyarrow.parquet.ParquetWriter(
+                filename, self.schema,
+                use_dictionary = [column for column, kind in columns if kind == 'code'])
+        else:
+            self.fh = open(filename, 'wb')
+            self.fh.write(MAGIC)
+
+
+    def add(self, row):
+        for append, value in zip(self.appends, row):
+            append(value)
+
+        self.rows += 1
+        if self.rows == self.row_group_size:
+            self.flush()
+
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        if self.fh:
+            write_row_group(self.fh, self.columns, self.values)
+        else:
+            self.writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(values, type = field.type)
+                 for values, field in zip(self.values, self.schema)],
+                schema = self.schema))
+
+        for values in self.values:
+            del values[:]
+        self.rows = 0
+
+
+    def close(self):
+        self.flush()
+
+        if self.fh:
+            self.fh.close()
+        else:
+            self.writer.close()
+
+
+def table_filename(dirname, table):
+    return os.path.join(dirname, table + ('.parquet' if pyarrow else '.col'))
+
+
+class ColumnarWriter(object):
+    """
+    Writes PNRs to the tables in `dirname`.
+    """
+    def __init__(self, dirname, row_group_size = ROW_GROUP_SIZE):
+        os.makedirs(dirname, exist_ok = True)
+
+        self.tables = dict((table, TableWriter(table_filename(dirname, table),
+                                               columns, row_group_size))
+                           for table, columns in TABLES)
+        self.count = 0
+
+
+    def add(self, pnr):
+        num = self.count
+        self.tables['pnrs'].add((pnr['regnum'],))
+
+        for table, key, type_ in ELEMENT_TABLES:
+            add = self.tables[table].add
+            for element in pnr[key] or EMPTY:
+                add((num,) + tuple(element))
+
+        self.count += 1
+
+
+    def close(self):
+        for writer in self.tables.values():
+            writer.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_table(dirname, table):
+    """
+    {column: values} of `table` saved in `dirname`.
+    """
+    columns = dict(TABLES)[table]
+    filename = os.path.join(dirname, table + '.col')
+
+    if not os.path.exists(filename):
+        if pyarrow is None:
+            raise ValueError("no table '{0}' in '{1}'".format(table, dirname))
+        return pyarrow.parquet.read_table(table_filename(dirname, table)).to_pydict()
+
+    values = dict((column, []) for column, kind in columns)
+    with open(filename, 'rb') as fh:
+        for group in read_row_groups(fh, columns):
+            for column, column_values in group.items():
+                values[column].extend(column_values)
+
+    return values
+
+
+def export_pnrs(records, dirname, settings, row_group_size = ROW_GROUP_SIZE):
+    """
+    Parse `records` and save them to `dirname`. Returns PNRs count.
+
+    Only the exported elements are parsed. Records which can not be parsed
+    are logged and skipped.
+    """
+    with ColumnarWriter(dirname, row_group_size) as writer:
+        for record in records:
+            try:
+                pnr = parse_pnr(record, settings)
+            except PnrParseException as e:
+                log.warning("Columnar export exception: %s", e)
+                continue
+
+            writer.add(pnr)
+
+    return writer.count
+
+
+def load_pnrs(dirname):
+    """
+    PNRs saved in `dirname`. Their exported elements are the ones parsed
+    from the dump (None if a PNR has none of them), the others are empty.
+    """
+    # millions of new tuples would start garbage collection again and
+    # again, though none of them can be a part of a reference cycle
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return build_pnrs(dirname)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def build_pnrs(dirname):
+    pnrs = []
+    for regnum in read_table(dirname, 'pnrs')['regnum']:
+        pnr = Pnr(regnum)
+        for table, key, type_ in ELEMENT_TABLES:
+            setattr(pnr, key, None)
+        pnrs.append(pnr)
+
+    for table, key, type_ in ELEMENT_TABLES:
+        values = read_table(dirname, table)
+        make = functools.partial(tuple.__new__, type_)
+        elements = list(map(make, zip(*[values[field] for field in type_._fields])))
+
+        # rows of a PNR go one after another
+        start = 0
+        for num, rows in itertools.groupby(values['pnr']):
+            end = start + sum(1 for row in rows)
+            setattr(pnrs[num], key, elements[start:end])
+            start = end
+
+    return pnrs
+
+
+def parse_opts():
+    parser = optparse.OptionParser(usage = '%prog [-y current_year] dump directory')
+
+    parser.add_option("-y", "--current_year", dest = "current_year", default = '2014',
+                      help = ("current year if need for broken itin records."
+                              "By default: 2014"))
+
+    opts, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error('You must specify a dump and a directory.')
+
+    opts.filename, opts.dirname = args
+
+    return opts
+
+
+if __name__ == "__main__":
+    opts = parse_opts()
+    count = export_pnrs(read_pnr_views(opts.filename), opts.dirname, opts)
+    print('{0}: {1} PNRs'.format(opts.dirname, count))
@@ -0,0 +1,100 @@
+"""
+CSV export of parsed PNRs.
+
+Three tables, each row starts with the regnum of its PNR:
+
+segments - a row for each passenger and segment (`settings.outfile`);
+ssr - a row for each SSR element (`settings.ssr_table`);
+osi - a row for each OSI element (`settings.osi_table`).
+
+Only the fixes which reject PNRs are applied, elements are exported as
+they are in the dump.
+"""
+
+import csv
+
+from pnr_types import *
+from pnr_telegram import fix_pnr, log_telegram_exception, FIX_ORDER
+
+
+PAX_COLUMNS = ('regnum', 'paxnum', 'surname', 'name', 'pax_status', 'group')
+ITIN_COLUMNS = ('airline', 'flightnum', 'itin_class', 'depdate', 'deppoint', 'arrpoint',
+                'status', 'nseats', 'deptime', 'arrtime', 'text')
+
+SEGMENT_COLUMNS = PAX_COLUMNS + ITIN_COLUMNS
+SSR_COLUMNS = ('regnum', 'code', 'airline', 'status', 'nseats', 'paxnum', 'text')
+OSI_COLUMNS = ('regnum', 'airline', 'paxnum', 'text')
+
+CSV_FIXES = [fix for fix in FIX_ORDER if fix.rejects]
+
+NO_PAX = (None,) * (len(PAX_COLUMNS) - 1)
+NO_ITIN = (None,) * len(ITIN_COLUMNS)
+
+
+def writer(out):
+    return csv.writer(out, lineterminator = '\n')
+
+
+def write_headers(settings):
+    """
+    Header rows of the tables, once at the beginning of the files.
+    """
+    writer(settings.outfile).writerow(SEGMENT_COLUMNS)
+    writer(settings.ssr_table).writerow(SSR_COLUMNS)
+    writer(settings.osi_table).writerow(OSI_COLUMNS)
+
+
+def segment_rows(pnr):
+    regnum = pnr['regnum']
+
+    paxes = [(regnum, paxnum, pax.surname, pax.name, pax.status, int(bool(pax.group)))
+             for paxnum, pax in enumerate(pnr['name'] or EMPTY, 1)]
+
+    itins = [(itin.airline, itin.flightnum, itin.itin_class,
+              itin.depdate.isoformat() if itin.depdate else None,
+              itin.deppoint, itin.arrpoint, itin.status, itin.nseats,
+              itin.deptime, itin.arrtime, itin.text)
+             for itin in pnr['segment'] or EMPTY]
+
+    if not paxes and not itins:
+        return EMPTY
+
+    return [pax + itin
+            for pax in paxes or [(regnum,) + NO_PAX]
+            for itin in itins or [NO_ITIN]]
+
+
+def write_csv(pnr, settings, out):
+    """
+    Write segment rows of `pnr` to `out` (`io.StringIO`), its SSR and OSI
+    rows to the tables of `settings`.
+
+    Returns False if the PNR is rejected.
+    """
+    regnum = pnr['regnum']
+
+    try:
+        pnr, text = fix_pnr(pnr, settings, CSV_FIXES)
+    except PnrParseException as e:
+        log_telegram_exception(regnum, e, None)
+        return True
+
+    if not pnr:
+        if settings.ignored:
+            settings.ignored.write('Regnum: {0} Reason: {1}\n'.format(regnum, text))
+        return False
+
+    writer(out).writerows(segment_rows(pnr))
+
+    ssrs = pnr['ssr']
+    if ssrs:
+        writer(settings.ssr_table).writerows(
+            (regnum, ssr.code, ssr.airline, ssr.status, ssr.nseats, ssr.paxnum, ssr.text)
+            for ssr in ssrs)
+
+    osis = pnr['osi']
+    if osis:
+        writer(settings.osi_table).writerows(
+            (regnum, osi.airline, osi.paxnum, osi.text) for osi in osis)
+
+    return True
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Difference between two PNR dumps.
+
+Records are fingerprinted by regnum and the digest of their bytes kept in
+the dump index, so a dump is compared with the previous one (or with the
+index left of it) without parsing either of them.
+
+Usage: ./pnr_delta.py previous current
+"""
+
+import os
+import sys
+
+from pnr_index import open_index, load_index_entries, is_index, dump_filename_for
+
+
+def load_fingerprints(filename):
+    """
+    Digests of records of dump or index `filename` by regnum.
+
+    An index is used as is, a dump is indexed if it is not yet. An index
+    of an older version is rebuilt from its dump, raises ValueError if the
+    dump is gone.
+    """
+    if not is_index(filename):
+        with open_index(filename) as index:
+            entries = list(index.entries())
+    else:
+        try:
+            entries = load_index_entries(filename)
+        except ValueError as e:
+            dump = dump_filename_for(filename)
+            if dump is None or not os.path.isfile(dump) or is_index(dump):
+                raise ValueError('{0}, its dump is not found to rebuild it'.format(e))
+
+            with open_index(dump, filename) as index:
+                entries = list(index.entries())
+
+    # records without regnum can not be matched, they are always new
+    return dict((e.regnum, e.digest) for e in entries if e.regnum)
+
+
+def changed_entries(index, previous, start = 0):
+    """
+    Yields entries of `index` starting with the record number `start`
+    which are new or differ from their `previous` fingerprints.
+    """
+    for entry in index.entries():
+        if entry.ordinal >= start and previous.get(entry.regnum) != entry.digest:
+            yield entry
+
+
+def deleted_regnums(index, previous):
+    """
+    Regnums of `previous` fingerprints which are not in `index`.
+    """
+    current = set(entry.regnum for entry in index.entries())
+
+    return sorted(regnum for regnum in previous if regnum not in current)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit(__doc__.strip())
+
+    try:
+        previous = load_fingerprints(sys.argv[1])
+    except ValueError as e:
+        sys.exit(str(e))
+
+    with open_index(sys.argv[2]) as index:
+        changed = sum(1 for entry in changed_entries(index, previous))
+        deleted = deleted_regnums(index, previous)
+
+    print('{0}: {1} changed, {2} deleted'.format(sys.argv[2], changed, len(deleted)))
+    for regnum in deleted:
+        print(regnum)
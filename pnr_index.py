@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Byte-offset index of PNR dump records.
+
+The index is a sidecar file `<dump>.idx` with the byte offset, length,
+regnum and content digest of each record, so a record can be fetched by its
+ordinal number or regnum without reading the records before it, and two
+dumps can be compared by their indexes alone.
+
+Usage: ./pnr_index.py dump [dump ...]
+"""
+
+import hashlib
+import os
+import struct
+import sys
+
+from pnr_read import PnrDump, RecordView, record_regnum
+from pnr_types import *
+
+
+# indexes of all versions start with it
+MAGIC_PREFIX = b'PNRIDX'
+
+MAGIC = MAGIC_PREFIX + b'2\n'
+
+# magic, dump size, dump mtime (ns), records count
+HEADER = struct.Struct('<8sQQQ')
+
+# record offset, record length, regnum, digest of the record bytes
+ENTRY = struct.Struct('<QI8s8s')
+
+# longer regnums are not kept, their records can not be found by regnum
+REGNUM_SIZE = 8
+
+DIGEST_SIZE = 8
+
+
+def index_filename_for(filename):
+    return filename + '.idx'
+
+
+def dump_filename_for(index_filename):
+    """
+    Dump of `index_filename` named the usual way or None.
+    """
+    if not index_filename.endswith('.idx'):
+        return None
+
+    return index_filename[:-len('.idx')]
+
+
+def is_index(filename):
+    """
+    Whether `filename` is an index of any version.
+    """
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC_PREFIX)) == MAGIC_PREFIX
+
+
+def record_digest(raw):
+    """
+    Digest of `raw` record bytes.
+    """
+    return hashlib.blake2b(raw, digest_size = DIGEST_SIZE).digest()
+
+
+def dump_signature(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns
+
+
+def build_index(filename, index_filename = None):
+    """
+    Write the index of dump `filename`. Returns records count.
+    """
+    if is_index(filename):
+        raise ValueError("'{0}' is an index, not a dump".format(filename))
+
+    index_filename = index_filename or index_filename_for(filename)
+    size, mtime = dump_signature(filename)
+    tmp = index_filename + '.tmp'
+
+    count = 0
+    with PnrDump(filename) as dump, open(tmp, 'wb') as fh:
+        fh.write(HEADER.pack(MAGIC, size, mtime, 0))
+
+        pack = ENTRY.pack
+        for view in dump.records():
+            regnum = (record_regnum(view) or '').encode('utf-8')
+            if len(regnum) > REGNUM_SIZE:
+                regnum = b''
+            fh.write(pack(view.start, view.end - view.start, regnum,
+                          record_digest(view.raw())))
+            count += 1
+
+        fh.seek(0)
+        fh.write(HEADER.pack(MAGIC, size, mtime, count))
+
+    os.replace(tmp, index_filename)
+
+    return count
+
+
+class RecordIndex(object):
+    """
+    Random access to records of dump `filename` through its index.
+
+    Raises ValueError if the index does not belong to the dump.
+    """
+    def __init__(self, filename, index_filename = None):
+        index_filename = index_filename or index_filename_for(filename)
+
+        self.fh = open(index_filename, 'rb')
+        try:
+            header = self.fh.read(HEADER.size)
+            if len(header) != HEADER.size:
+                raise ValueError("broken index: '{0}'".format(index_filename))
+
+            magic, size, mtime, self.count = HEADER.unpack(header)
+            if magic != MAGIC or (size, mtime) != dump_signature(filename):
+                raise ValueError("stale index: '{0}'".format(index_filename))
+
+            self.dump = PnrDump(filename)
+        except Exception:
+            self.fh.close()
+            raise
+
+        self._ordinals = None
+
+
+    def close(self):
+        self.dump.close()
+        self.fh.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __len__(self):
+        return self.count
+
+
+    def entry(self, ordinal):
+        if not 0 <= ordinal < self.count:
+            raise IndexError("no record number {0}".format(ordinal))
+
+        self.fh.seek(HEADER.size + ordinal * ENTRY.size)
+
+        return make_entry(ordinal, ENTRY.unpack(self.fh.read(ENTRY.size)))
+
+
+    def entries(self):
+        return read_entries(self.fh, self.count)
+
+
+    def find(self, regnum):
+        """
+        Ordinal number of the record with `regnum`. Raises KeyError.
+        """
+        if self._ordinals is None:
+            self._ordinals = dict((e.regnum, e.ordinal) for e in self.entries())
+
+        return self._ordinals[regnum]
+
+
+    def view(self, entry):
+        return RecordView(self.dump.buf, entry.offset, entry.offset + entry.length)
+
+
+    def by_ordinal(self, ordinal):
+        return self.view(self.entry(ordinal))
+
+
+    def by_regnum(self, regnum):
+        return self.by_ordinal(self.find(regnum))
+
+
+    def records(self, start = 0):
+        """
+        Yields records starting with the record number `start`.
+        """
+        if start >= self.count:
+            return
+
+        for view in self.dump.records(self.entry(start).offset):
+            yield view
+
+
+def make_entry(ordinal, fields):
+    offset, length, regnum, digest = fields
+
+    return IndexEntry(ordinal = ordinal,
+                      offset = offset,
+                      length = length,
+                      regnum = regnum.rstrip(b'\0').decode('utf-8'),
+                      digest = digest)
+
+
+def read_entries(fh, count):
+    """
+    Yields `count` entries of index file `fh`.
+    """
+    fh.seek(HEADER.size)
+    data = fh.read(count * ENTRY.size)
+
+    for ordinal, fields in enumerate(ENTRY.iter_unpack(data)):
+        yield make_entry(ordinal, fields)
+
+
+def load_index_entries(index_filename):
+    """
+    Entries of `index_filename` read without its dump, which may be gone.
+
+    Raises ValueError if it is not an index of the current version.
+    """
+    with open(index_filename, 'rb') as fh:
+        header = fh.read(HEADER.size)
+        if len(header) != HEADER.size or not header.startswith(MAGIC_PREFIX):
+            raise ValueError("not an index: '{0}'".format(index_filename))
+
+        if HEADER.unpack(header)[0] != MAGIC:
+            raise ValueError("unsupported index version: '{0}'".format(index_filename))
+
+        return list(read_entries(fh, HEADER.unpack(header)[3]))
+
+
+def open_index(filename, index_filename = None):
+    """
+    Open the index of dump `filename`, (re)build it if it is missing or stale.
+    """
+    try:
+        return RecordIndex(filename, index_filename)
+    except (OSError, ValueError):
+        build_index(filename, index_filename)
+
+    return RecordIndex(filename, index_filename)
+
+
+def load_regnums(filename):
+    """
+    Read regnums from `filename`.
+
+    Takes either one regnum per line or the ignored PNRs file lines
+    `Regnum: <regnum> Reason: <reason>`.
+    """
+    regnums = []
+    seen = set()
+
+    with open(filename, 'r') as fh:
+        for line in fh:
+            words = line.split()
+            if not words:
+                continue
+
+            regnum = words[1] if words[0] == 'Regnum:' and len(words) > 1 else words[0]
+            if regnum not in seen:
+                seen.add(regnum)
+                regnums.append(regnum)
+
+    return regnums
+
+
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        print('{0}: {1} records'.format(filename, build_index(filename)))
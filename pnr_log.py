@@ -0,0 +1,180 @@
+"""
+Logging of the conversion through a single writer.
+
+All processes put log records to one queue (`QueueHandler`), the main
+process writes them to the log file from a listener thread, so workers
+neither wait for the file nor mix their messages in it.
+
+Messages are formatted with `%` arguments, so nothing is formatted for
+disabled levels. Repeated failures have a `kind` (`extra = kind(...)`);
+in the summary mode only the first messages of each kind are written
+and the rest are counted and reported when logging stops. Each process
+drops the messages over the limit itself (`SummaryFilter`), so they are
+neither formatted nor sent, and sends only their numbers.
+"""
+
+import collections
+import logging
+import logging.handlers
+import multiprocessing
+import os
+
+
+FORMAT = '%(asctime)s %(levelname)s:\n%(message)s'
+
+
+def kind(text):
+    """
+    `extra` of a message about a failure of kind `text`.
+    """
+    return {'kind': text}
+
+
+def failure_kind(e):
+    """
+    Kind of a failure from its exception: the message up to the element
+    text, like `can't parse ssr`.
+    """
+    return str(e).partition(':')[0]
+
+
+class SummaryHandler(logging.Handler):
+    """
+    Passes records to `target`, but only the first `limit` ones of each
+    kind. The numbers of the others are written when the handler is closed.
+    """
+    def __init__(self, target, limit):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.limit = limit
+        self.counts = collections.Counter()
+
+
+    def emit(self, record):
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed is not None:
+            # failures dropped by `SummaryFilter` of a process
+            self.counts.update(suppressed)
+            return
+
+        failure = getattr(record, 'kind', None)
+        if failure is not None:
+            self.counts[failure] += 1
+            if self.counts[failure] > self.limit:
+                return
+
+        self.target.handle(record)
+
+
+    def summary(self):
+        lines = ['{0} x{1}'.format(failure, count)
+                 for failure, count in self.counts.most_common()]
+
+        return 'Failures:\n' + '\n'.join(lines) if lines else ''
+
+
+    def close(self):
+        text = self.summary()
+        if text:
+            self.target.handle(logging.makeLogRecord(
+                {'msg': text, 'levelno': logging.WARNING, 'levelname': 'WARNING'}))
+            self.counts.clear()
+
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class SummaryFilter(logging.Filter):
+    """
+    Lets only the first `limit` records of each failure kind of this
+    process through. The others are counted, `send_counts` passes their
+    numbers on.
+    """
+    def __init__(self, limit):
+        logging.Filter.__init__(self)
+        self.limit = limit
+        self.pid = os.getpid()
+        self.counts = collections.Counter()
+        self.suppressed = collections.Counter()
+
+
+    def filter(self, record):
+        failure = getattr(record, 'kind', None)
+        if failure is None:
+            return True
+
+        if self.pid != os.getpid():
+            # forked, the counts are of the parent process
+            self.pid = os.getpid()
+            self.counts.clear()
+            self.suppressed.clear()
+
+        self.counts[failure] += 1
+        if self.counts[failure] <= self.limit:
+            return True
+
+        self.suppressed[failure] += 1
+        return False
+
+
+    def send_counts(self, handler):
+        if self.pid != os.getpid() or not self.suppressed:
+            return
+
+        handler.handle(logging.makeLogRecord(
+            {'msg': 'Suppressed failures', 'levelno': logging.DEBUG, 'levelname': 'DEBUG',
+             'suppressed': dict(self.suppressed)}))
+        self.suppressed.clear()
+
+
+def send_counts():
+    """
+    Send the numbers of failures dropped in this process so far. Called
+    by worker processes when they are done with a piece of work.
+    """
+    for handler in logging.getLogger().handlers:
+        for f in handler.filters:
+            if isinstance(f, SummaryFilter):
+                f.send_counts(handler)
+
+
+def start_logging(filename, level = logging.DEBUG, summary = 0):
+    """
+    Send log records of this process and of the processes forked from
+    it to `filename` through a queue.
+
+    With `summary` only so many messages of each failure kind are
+    written. Returns the listener to give to `stop_logging`.
+    """
+    handler = logging.FileHandler(filename, mode = 'w')
+    handler.setFormatter(logging.Formatter(FORMAT))
+
+    if summary:
+        handler = SummaryHandler(handler, summary)
+
+    records = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+    sender = logging.handlers.QueueHandler(records)
+    if summary:
+        sender.addFilter(SummaryFilter(summary))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(sender)
+    root.setLevel(level)
+
+    return listener
+
+
+def stop_logging(listener):
+    """
+    Write the records left in the queue and close the log file.
+    """
+    send_counts()
+    listener.stop()
+
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,147 @@
+"""
+Output files of the conversion: telegrams and ignored PNRs.
+
+Text is collected in memory and written in large blocks, so a run makes
+a few writes per megabyte whatever the number of PNRs is. Telegrams may
+be compressed with gzip or, if the `zstandard` package is installed, zstd.
+"""
+
+import contextlib
+import gzip
+import signal
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BLOCK_SIZE = 2 ** 20
+
+COMPRESSIONS = ('gzip', 'zstd')
+
+DEFERRED_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+@contextlib.contextmanager
+def deferred_signals():
+    """
+    Delay SIGINT and SIGTERM until the end of the block, so a stopped run
+    never leaves half of a write (a broken compressed stream) behind.
+
+    Signals are handled by the main thread only, so only it needs this.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    received = []
+
+    def defer(signum, frame):
+        received.append(signum)
+
+
+    handlers = [signal.signal(signum, defer) for signum in DEFERRED_SIGNALS]
+    try:
+        yield
+    finally:
+        for signum, handler in zip(DEFERRED_SIGNALS, handlers):
+            signal.signal(signum, handler)
+
+        if received:
+            signal.raise_signal(received[0])
+
+
+class BlockWriter(object):
+    """
+    Text stream over the binary stream `fh`, the text is encoded and
+    written to it in blocks of about `block_size` characters.
+
+    `close` writes what is left, closes the `owned` streams (`fh` and the
+    ones under it) in that order and flushes the lowest stream `raw` if
+    it is left open.
+    """
+    def __init__(self, fh, owned = (), block_size = BLOCK_SIZE, raw = None):
+        self.fh = fh
+        self.owned = owned
+        self.raw = raw
+        self.block_size = block_size
+        self.parts = []
+        self.size = 0
+        self.closed = False
+
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+
+        if self.size >= self.block_size:
+            self.write_block()
+
+
+    def write_block(self):
+        if self.parts:
+            data = ''.join(self.parts).encode('utf-8')
+            self.parts = []
+            self.size = 0
+
+            with deferred_signals():
+                self.fh.write(data)
+
+
+    def flush(self):
+        self.write_block()
+
+        with deferred_signals():
+            self.fh.flush()
+
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.write_block()
+
+        with deferred_signals():
+            for fh in self.owned:
+                fh.close()
+
+            if self.raw is not None and not self.raw.closed:
+                self.raw.flush()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_output(target, compression = None, block_size = BLOCK_SIZE):
+    """
+    `BlockWriter` to file name or text stream (like `sys.stdout`) `target`.
+
+    A stream given is flushed and closed by the writer, but its file is not.
+    """
+    if isinstance(target, str):
+        raw = open(target, 'wb')
+        owned = [raw]
+    else:
+        target.flush()
+        raw = target.buffer
+        owned = []
+
+    if compression == 'gzip':
+        fh = gzip.GzipFile(fileobj = raw, mode = 'wb')
+    elif compression == 'zstd':
+        fh = zstandard.ZstdCompressor().stream_writer(raw, closefd = False)
+    else:
+        fh = raw
+
+    if fh is not raw:
+        owned.insert(0, fh)
+
+    return BlockWriter(fh, owned, block_size, raw)
@@ -1,5 +1,6 @@
 import re
 import os
+import functools
 import sys
 import logging
 import optparse
@@ -8,6 +9,67 @@ from datetime import datetime
 
 from pnr_types import *
 from pnr_utils import *
+from pnr_log import kind, failure_kind
+
+
+log = logging.getLogger(__name__)
+
+
+################################################################################
+# GRAMMARS
+################################################################################
+
+GRAMMARS = {
+    "paxes": re.compile(r"\s*[0-9]{1,2}\."),
+
+    "pax": re.compile(r"^\s*(?P<surname>[^/]+)"
+                      r"(?:/(?P<name>.*?)\s*"
+                      r"(?:(?P<status>(?:MISS|MS|MRS|MSS|"
+                                       r"CHD|CHLD|CH|"
+                                       r"INF|INFT|"
+                                       r"MSTR|MR)))?)?$"),
+
+    "ssr": re.compile(r"^SSR\s+(?P<code>[^\s]+)\s+"
+                      r"(?P<airline>[^\s]+)\s+"
+                      r"(?:(?P<status>[^\d]{1,3})(?P<nseats>[\d]{1})?)?"
+                      r"\s+(?P<text>.*?)"
+                      r"(?:(?P<slashp>/P)(?P<paxnum>[\d]{1,2})?)?$"),
+
+    "itin": re.compile(r"^\s*(?P<airline>[^\s]+)"
+                       r"\s+(?P<flightnum>[^\s]+)"
+                       r"\s+(?P<itin_class>[^\s]{1})\s+"
+                       r"(?P<depdate>[^\s]{7,9})?"
+                       r"\s*(?P<deppoint>[^\s]{3})(?P<arrpoint>[^\s]{3})?"
+                       r"(?:\s+(?P<status>[^\s]{2}))?"
+                       r"(?P<nseats>[^\s]+)?"
+                       r"(?:\s+(?P<deptime>[^\s]+))?"
+                       r"(?:\s+(?P<arrtime>[^\sa-zA-Z]+))?"
+                       r"\s*(?P<text>.*?)?$"),
+
+    "arrtime": re.compile(r"[^\sa-zA-Z]*"),
+
+    "osi": re.compile(r"^OSI\s+(?:\#\d+\s+)?(?P<airline>[^\s]+)\s+"
+                      r"(?P<text>.*?)"
+                      r"(?:(?P<slashp>/P)(?P<paxnum>[\d]{1,2})?)?$"),
+
+    "remarks": re.compile(r"^(?P<text>.+?)(?:(?P<slashp>/P)(?P<paxnum>[\d]{1,2})?)?$"),
+
+    "endorsement": re.compile(r"^(?P<text>.+?)"
+                              r"(?:/P(?P<paxnum>[\d]{1,2}))?"
+                              r" [^/]+$"),
+
+    "auxiliary": re.compile(r"^SVC\s+(?P<airline>[^\s]+)\s+"
+                            r"(?:(?P<status>[^\d]{1,3})(?P<nseats>[\d]{1})?)?\s+"
+                            r"(?P<primary_loc_code>[^\s]{3})(?P<secondary_loc_code>[^\s]{3})?\s+"
+                            r"(?P<service_date>[^\s]{5,7})\s+"
+                            r"(?P<text>.+?)"
+                            r"\..*?"
+                            r"(?:(?P<slashp>/P)(?P<paxnum>[\d]{1,2})?)?$"),
+
+    "group": re.compile(r"^\s*(?P<total>[0-9]+)?"
+                        r"(?P<group_1>.+?)(?:/(?P<group_2>.+?))?"
+                        r"\s+NM(?P<named>[0-9]+)$"),
+}
 
 
 ################################################################################
@@ -32,19 +94,14 @@ def guess_paxnum(raw_pnr, where):
     raise PnrParseException("can't guess paxnum in '{0}'".format(where))
 
 
-def pass_in_group(name, surname, raw_pnr):
+def pass_in_group(raw_pnr):
     """
-    Check if pass with `name` and `surname` in group.
-    """
-    assert surname is not None, "no surname for pass! {0}".format(raw_pnr)
-
-    passname = "/".join([surname, name]) if name is not None else surname
-    if raw_pnr and raw_pnr["group_name"]:
-        for record in raw_pnr["name"]:
-            if passname in record:
-                return True
+    Check if passengers of `raw_pnr` are in group.
 
-    return False
+    Each passenger of a PNR with a group name is one of its names, so it
+    is the same for all of them and is found once per PNR.
+    """
+    return bool(raw_pnr and raw_pnr["group_name"])
 
 
 def cut_regnum_from_pax(text):
@@ -91,51 +148,53 @@ def init_raw_pnr():
     return d
 
 
-def combine_fields(record):
+def classify_line(line):
     """
-    Concatenates string fields of objects.
-    """
-    def get_code(line):
-        for name, value in PNR_OBJS.items():
-            if line[:2] == value.code:
-                return name
+    Classify raw record `line` in one pass.
 
+    Returns the field name, whether the line continues the previous element
+    of the field and the line text without element code and line number.
+    """
+    field = FIELD_BY_CODE.get(line[:2])
+    if field is None:
         raise PnrParseException("wrong code in line: '%s'" % line)
 
+    text = line[2:].lstrip()
+    dot = text.find('.', 0, 4)
 
-    def parse_paxes(line):
-        return (s.strip() for s in re.split("\s*[0-9]{1,2}\.", line) if s.strip())
+    if dot < 0:
+        return field, True, text
 
+    if field == 'name':
+        # passengers line numbers are cut by `parse_paxes`
+        return field, False, line[4:]
 
-    def is_continued(line):
-        return '.' not in line.lstrip()[:4]
+    return field, False, text[dot + 1:].strip()
 
 
-    def is_passengers(code):
-        return code == 'name'
+def combine_fields(record):
+    """
+    Concatenates string fields of objects.
+    """
+    def parse_paxes(line):
+        return (s.strip() for s in GRAMMARS["paxes"].split(line) if s.strip())
 
 
     d = init_raw_pnr()
 
     for line in record:
-        code = get_code(line)
-        line = line[2:]
+        field, continued, text = classify_line(line)
+        elems = d[field]
 
-        if is_continued(line):
-            line = line.lstrip()
-            if line and line[0] == '/' or d[code][-1][-1] == '/':
-                line = line
+        if continued:
+            if text and text[0] == '/' or elems[-1][-1] == '/':
+                elems[-1] += text
             else:
-                line = ' ' + line
-
-            d[code][-1] += line
+                elems[-1] += ' ' + text
+        elif field == 'name':
+            elems.extend(parse_paxes(text))
         else:
-            if is_passengers(code):
-                [d[code].append(l) for l in parse_paxes(line[2:]) if l]
-            else:
-                dot = line.find('.') + 1
-                without_line_num = line[dot:].strip()
-                d[code].append(without_line_num)
+            elems.append(text)
 
     return d
 
@@ -153,36 +212,36 @@ def get_depdate(s, settings):
     if not s:
         return None
 
+    return decode_depdate(s, settings.current_year)
+
+
+@functools.lru_cache(maxsize = 4096)
+def decode_depdate(s, current_year):
+    """
+    Decode date like `MO09JUN14`, `10JUN14`, `MO09JUN` or `09JUN`.
+
+    Dates without year are in `current_year`. A dump has a few hundred
+    distinct dates only, so decoded ones are cached.
+    """
     if len(s) == 9:
-        f = '%d%b%y'
-        fixed_date = s[2:]
+        return make_date(s[2:4], s[4:7], s[7:])
     elif len(s) == 7:
         if s[:2].isdigit():
-            f = '%d%b%y'
-            fixed_date = s
+            return make_date(s[:2], s[2:5], s[5:])
         else:
-            f = '%d%b%Y'
-            fixed_date = s[2:] + settings.current_year
+            return make_date(s[2:4], s[4:], current_year, full_year = True)
     elif len(s) == 5:
-        f = '%d%b%Y'
-        fixed_date = s + settings.current_year
+        return make_date(s[:2], s[2:], current_year, full_year = True)
     else:
         raise PnrParseException('Wrong depdate: {0}'.format(s))
 
-    return datetime.strptime(fixed_date, f).date()
-
 
 ################################################################################
 # MAIN PARSE FUNCTIONS
 ################################################################################
 
-def parse_pax(text, raw_pnr, settings):
-    m = re.search((r"^\s*(?P<surname>[^/]+)"
-                   "(?:/(?P<name>.*?)\s*"
-                   "(?:(?P<status>(?:MISS|MS|MRS|MSS|"
-                                    "CHD|CHLD|CH|"
-                                    "INF|INFT|"
-                                    "MSTR|MR)))?)?$"), text)
+def parse_pax(text, raw_pnr, settings, in_group = None):
+    m = GRAMMARS["pax"].search(text)
     if not m:
         raise PnrParseException("can't parse pax: '{0}'".format(text))
 
@@ -190,17 +249,11 @@ def parse_pax(text, raw_pnr, settings):
                surname = m.group("surname"),
                status = m.group("status"),
                nseats = 1,
-               group = pass_in_group(name = m.group("name"),
-                                     surname = m.group("surname"),
-                                     raw_pnr = raw_pnr))
+               group = pass_in_group(raw_pnr) if in_group is None else in_group)
 
 
 def parse_ssr(text, raw_pnr, settings):
-    m = re.search((r"^SSR\s+(?P<code>[^\s]+)\s+"
-                   "(?P<airline>[^\s]+)\s+"
-                   "(?:(?P<status>[^\d]{1,3})(?P<nseats>[\d]{1})?)?"
-                   "\s+(?P<text>.*?)"
-                   "(?:(?P<slashp>/P)(?P<paxnum>[\d]{1,2})?)?$"), text)
+    m = GRAMMARS["ssr"].search(text)
     if not m:
         raise PnrParseException("can't parse ssr: '{0}'".format(text))
 
@@ -216,17 +269,65 @@ def parse_ssr(text, raw_pnr, settings):
                paxnum = paxnum)
 
 
+def split_itin(text):
+    """
+    Split a segment text by its fixed columns like
+    `AC 003  C   MO09JUN  YVRNRT HK    1210 1425+1  TEXT`:
+    airline, flight, class, date, city pair, status+seats, departure time
+    and the rest (arrival time and free text).
+
+    Gives the same fields as the `itin` grammar. Returns None for segments
+    of other layouts (ARNK, OPEN and so on), they are left to the grammar.
+    """
+    tokens = text.split(None, 7)
+
+    if len(tokens) > 3 and len(tokens[3]) == 15:
+        # the date is glued to the city pair: `WE14MAY14UUSNGK`
+        tokens = text.split(None, 6)
+        date_cities = tokens[3]
+        tokens[3:4] = [date_cities[:9], date_cities[9:]]
+
+    if len(tokens) < 6:
+        return None
+
+    if len(tokens[2]) != 1 or len(tokens[3]) not in (7, 9) or \
+       len(tokens[4]) != 6 or len(tokens[5]) < 2:
+        return None
+
+    while len(tokens) < 8:
+        tokens.append(None)
+
+    return tokens
+
+
 def parse_itin(text, raw_pnr, settings):
-    m = re.search((r"^\s*(?P<airline>[^\s]+)"
-                   "\s+(?P<flightnum>[^\s]+)"
-                   "\s+(?P<itin_class>[^\s]{1})\s+"
-                   "(?P<depdate>[^\s]{7,9})?"
-                   "\s*(?P<deppoint>[^\s]{3})(?P<arrpoint>[^\s]{3})?"
-                   "(?:\s+(?P<status>[^\s]{2}))?"
-                   "(?P<nseats>[^\s]+)?"
-                   "(?:\s+(?P<deptime>[^\s]+))?"
-                   "(?:\s+(?P<arrtime>[^\sa-zA-Z]+))?"
-                   "\s*(?P<text>.*?)?$"), text)
+    tokens = split_itin(text)
+
+    if tokens is not None:
+        airline, flightnum, itin_class, depdate, cities, status, deptime, rest = tokens
+
+        arrtime = None
+        if rest:
+            arrtime = GRAMMARS["arrtime"].match(rest).group()
+            rest = rest[len(arrtime):].lstrip()
+
+        return Itin(airline = airline,
+                    flightnum = flightnum,
+                    itin_class = itin_class,
+                    depdate = get_depdate(depdate, settings),
+                    deppoint = cities[:3],
+                    arrpoint = cities[3:],
+                    status = status[:2],
+                    nseats = status[2:] or None,
+                    deptime = deptime,
+                    arrtime = arrtime or None,
+                    text = rest or '')
+
+    return parse_itin_grammar(text, raw_pnr, settings)
+
+
+def parse_itin_grammar(text, raw_pnr, settings):
+    m = GRAMMARS["itin"].search(text)
 
     if not m and text.startswith('ARNK'):
         return Itin(airline = None,
@@ -258,9 +359,7 @@ def parse_itin(text, raw_pnr, settings):
 
 
 def parse_osi(text, raw_pnr, settings):
-    m = re.search((r"^OSI\s+(?:\#\d+\s+)?(?P<airline>[^\s]+)\s+"
-                   "(?P<text>.*?)"
-                   "(?:(?P<slashp>/P)(?P<paxnum>[\d]{1,2})?)?$"), text)
+    m = GRAMMARS["osi"].search(text)
 
     # m = re.search((r"^OSI\s+(?P<airline>[^\s]+)\s+"
     #                "(?P<text>.*?)"
@@ -279,7 +378,7 @@ def parse_osi(text, raw_pnr, settings):
 
 
 def parse_remarks(text, raw_pnr, settings):
-    m = re.search(r'^(?P<text>.+?)(?:(?P<slashp>/P)(?P<paxnum>[\d]{1,2})?)?$', text)
+    m = GRAMMARS["remarks"].search(text)
 
     if not m:
         raise PnrParseException("can't parse remarks: '{0}'".format(text))
@@ -301,9 +400,7 @@ def parse_responsibility(text, raw_pnr, settings):
 
 
 def parse_endorsement(text, raw_pnr, settings):
-    m = re.search(r'^(?P<text>.+?)'
-                  '(?:/P(?P<paxnum>[\d]{1,2}))?'
-                  ' [^/]+$', text)
+    m = GRAMMARS["endorsement"].search(text)
 
     if not m:
         raise PnrParseException('wrong endorsement: {0}'.format(text))
@@ -313,13 +410,7 @@ def parse_endorsement(text, raw_pnr, settings):
 
 
 def parse_auxiliary(text, raw_pnr, settings):
-    m = re.search(r'^SVC\s+(?P<airline>[^\s]+)\s+'
-                  '(?:(?P<status>[^\d]{1,3})(?P<nseats>[\d]{1})?)?\s+'
-                  '(?P<primary_loc_code>[^\s]{3})(?P<secondary_loc_code>[^\s]{3})?\s+'
-                  '(?P<service_date>[^\s]{5,7})\s+'
-                  '(?P<text>.+?)'
-                  '\..*?'
-                  '(?:(?P<slashp>/P)(?P<paxnum>[\d]{1,2})?)?$', text)
+    m = GRAMMARS["auxiliary"].search(text)
 
     if not m:
         raise PnrParseException("can't parse auxiliary(SVC): '{0}'".format(text))
@@ -339,9 +430,7 @@ def parse_auxiliary(text, raw_pnr, settings):
 
 
 def parse_group(text, raw_pnr, settings):
-    m = re.search(r'^\s*(?P<total>[0-9]+)?'
-                  '(?P<group_1>.+?)(?:/(?P<group_2>.+?))?'
-                  '\s+NM(?P<named>[0-9]+)$', text)
+    m = GRAMMARS["group"].search(text)
 
     if not m:
         raise PnrParseException("can't parse group: '{0}'".format(text))
@@ -357,6 +446,9 @@ def parse_group(text, raw_pnr, settings):
                  named = m.group('named'))
 
 
+PARSE_SEPARATOR = '-' * 80
+
+
 def parse_objs(field_value, raw_pnr, settings, fn):
     """
     Parses PNR objects from a list of objects string representation.
@@ -373,38 +465,48 @@ def parse_objs(field_value, raw_pnr, settings, fn):
             l_append(fn(text, raw_pnr, settings))
 
         except PnrParseException as e:
-            logging.warning(
-                "{0}\n"
-                "Parse PNR exception.\n"
-                "PNR: {1}\nException: {2}\n"
-                "{3}\n\n".format('-' * 80, raw_pnr['regnum'], e, '-' * 80))
+            log.warning("%s\nParse PNR exception.\nPNR: %s\nException: %s\n%s\n\n",
+                        PARSE_SEPARATOR, raw_pnr['regnum'], e, PARSE_SEPARATOR,
+                        extra = kind(failure_kind(e)))
 
     return l
 
 
-def collect_pnr(raw_pnr, settings):
+class ElementLoader(object):
     """
-    Create PNR from text presentation of elements.
+    `Pnr` loader parsing elements of `raw_pnr` on their first access.
 
-    If on of elements throw an exception when created, skip this element.
+    The PNR drops it (with the raw PNR) when all its elements are parsed.
     """
-    pnr = init_raw_pnr()
-    pnr['regnum'] = raw_pnr['regnum']
-    handled_keys = PNR_OBJS.keys()
+    __slots__ = ('raw_pnr', 'settings')
 
-    for field, value in raw_pnr.items():
-        if field not in handled_keys:
-            continue
+    def __init__(self, raw_pnr, settings):
+        self.raw_pnr = raw_pnr
+        self.settings = settings
 
+
+    def __call__(self, field):
         fn = PNR_OBJS[field].fn
 
         if not fn:
-            continue
+            return EMPTY
 
-        pnr[field] = parse_objs(value, raw_pnr, settings, fn)
+        if field == 'name':
+            fn = functools.partial(fn, in_group = pass_in_group(self.raw_pnr))
 
+        return parse_objs(self.raw_pnr[field], self.raw_pnr, self.settings, fn)
 
-    return pnr
+
+def collect_pnr(raw_pnr, settings):
+    """
+    Create PNR from text presentation of elements.
+
+    Elements are parsed on first access only, so a PNR rejected because of
+    its segments or passengers does not pay for the others.
+
+    If on of elements throw an exception when created, skip this element.
+    """
+    return Pnr(raw_pnr['regnum'], loader = ElementLoader(raw_pnr, settings))
 
 
 def parse_pnr(record, settings):
@@ -441,3 +543,6 @@ PNR_OBJS = {
     "ticketing_data":          CodeFn('24', None),
     "responsibility":          CodeFn('31', parse_responsibility),
 }
+
+
+FIELD_BY_CODE = dict((value.code, name) for name, value in PNR_OBJS.items())
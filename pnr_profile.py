@@ -0,0 +1,97 @@
+"""
+Slowest PNRs of a run: wall time of each conversion stage of a record
+and a bounded heap of the records which took the longest.
+
+Profiling is off unless `settings.profile` (the number of records to
+keep) is set, then `write_telegram` times each record with `RecordTimer`.
+Like `pnr_stats`, each process keeps its own records, workers send theirs
+to the main process (`take_slowest`) and it merges them (`add_slowest`).
+"""
+
+import heapq
+import itertools
+
+from time import perf_counter
+
+
+# (seconds, sequence number, regnum, [(stage, seconds), ...], record text),
+# the fastest of the kept records first
+SLOWEST = []
+
+SEQUENCE = itertools.count()
+
+
+class RecordTimer(object):
+    """
+    Wall time of the stages of one record, each stage lasts from the
+    previous `lap` (or the creation of the timer) to its own.
+    """
+    __slots__ = ('stages', 'last')
+
+    def __init__(self):
+        self.stages = []
+        self.last = perf_counter()
+
+
+    def lap(self, stage):
+        now = perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+
+    def total(self):
+        return sum(seconds for stage, seconds in self.stages)
+
+
+def keep_slowest(item, limit):
+    if len(SLOWEST) < limit:
+        heapq.heappush(SLOWEST, item)
+    elif item > SLOWEST[0]:
+        heapq.heapreplace(SLOWEST, item)
+
+
+def add_record(timer, regnum, record, limit):
+    """
+    Keep `record` if it is one of the `limit` slowest ones.
+
+    `regnum` is a function of the record, its text and regnum are taken
+    only if the record is kept.
+    """
+    total = timer.total()
+    if len(SLOWEST) >= limit and total <= SLOWEST[0][0]:
+        return
+
+    keep_slowest((total, next(SEQUENCE), regnum(record), timer.stages, '\n'.join(record)),
+                 limit)
+
+
+def take_slowest():
+    """
+    Records kept since the previous call.
+    """
+    slowest = SLOWEST[:]
+    del SLOWEST[:]
+
+    return slowest
+
+
+def add_slowest(slowest, limit):
+    for total, ignore, regnum, stages, text in slowest:
+        keep_slowest((total, next(SEQUENCE), regnum, stages, text), limit)
+
+
+def format_slowest():
+    """
+    Report of the kept records, the slowest first: regnum, total and
+    stages time and the raw record text.
+    """
+    lines = []
+    for num, (total, ignore, regnum, stages, text) in enumerate(
+            sorted(SLOWEST, reverse = True), 1):
+        lines.append('{0}. Regnum: {1} Time: {2:.3f} ms'.format(num, regnum, total * 1e3))
+        lines.append(', '.join('{0} {1:.3f} ms'.format(stage, seconds * 1e3)
+                               for stage, seconds in stages))
+        lines.append(text)
+        lines.append('')
+
+    return '\n'.join(lines)
@@ -1,3 +1,10 @@
+import mmap
+
+
+END_OF_PNR = b"****End of PNR Key"
+END_OF_DUMP = b"Total number of PNRs procesed"
+
+
 def read_pnr(filename):
     with open(filename, mode = "r", encoding = "utf-8") as fh:
         record = []
@@ -10,3 +17,256 @@ def read_pnr(filename):
                 record = []
             elif line:
                 record.append(line)
+
+
+def read_pnr_stream(fh):
+    """
+    Yields records of binary stream `fh` the same way `read_pnr` gives them.
+
+    The stream is read line by line, so only the current record is kept.
+    """
+    record = []
+    for chunk in fh:
+        for line in chunk.splitlines():
+            if END_OF_DUMP in line:
+                return
+            elif END_OF_PNR in line:
+                yield record
+                record = []
+            else:
+                line = line.strip()
+                if line:
+                    record.append(line.decode('utf-8'))
+
+
+def record_regnum(lines):
+    """
+    Regnum of a raw record.
+
+    It is the last word of the group name (02) element or, if there is
+    no group name, of the name (03) element. `pnr_parse.cut_regnum` cuts
+    the same one.
+    """
+    group = name = None
+    for line in lines:
+        code = line[:2]
+        if code == '02':
+            group = line
+        elif code == '03':
+            name = line
+
+    words = (group or name or '')[2:].split()
+    if not words:
+        return None
+
+    return words[-1]
+
+
+def has_airline_segment(lines, airline):
+    """
+    Whether a raw record has a segment (04) element of `airline`.
+
+    The airline is the first word of the element, the same one
+    `pnr_parse.parse_itin` gives.
+    """
+    for line in lines:
+        if line[:2] != '04':
+            continue
+
+        text = line[2:].lstrip()
+        dot = text.find('.', 0, 4)
+        if dot < 0:
+            # continuation of the previous element
+            continue
+
+        words = text[dot + 1:].split(None, 1)
+        if words and words[0] == airline:
+            return True
+
+    return False
+
+
+def line_start(buf, pos, lo = 0):
+    """
+    Byte offset of the beginning of the line containing `pos`.
+
+    Lines are never looked for before `lo`.
+    """
+    return max(lo - 1, buf.rfind(b'\n', lo, pos), buf.rfind(b'\r', lo, pos)) + 1
+
+
+def next_line(buf, pos, end):
+    """
+    Byte offset of the line following the one containing `pos`.
+    """
+    nl = buf.find(b'\n', pos, end)
+    cr = buf.find(b'\r', pos, end if nl < 0 else nl)
+
+    if cr >= 0:
+        return cr + 1
+    if nl >= 0:
+        return nl + 1
+
+    return end
+
+
+class RecordView(object):
+    """
+    Raw PNR record bytes inside of a dump.
+
+    Lines are decoded on first access only, so a record which is never
+    looked at costs nothing but its offsets. Views are valid while the
+    dump they came from is open.
+    """
+    __slots__ = ('buf', 'start', 'end', '_lines')
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+        self._lines = None
+
+
+    def raw(self):
+        return self.buf[self.start:self.end]
+
+
+    def lines(self):
+        """
+        Record lines the same way `read_pnr` gives them.
+        """
+        if self._lines is None:
+            text = self.raw().decode('utf-8')
+            if '\r' in text:
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+            self._lines = [line for line in map(str.strip, text.split('\n')) if line]
+
+        return self._lines
+
+
+    def __iter__(self):
+        return iter(self.lines())
+
+
+    def __len__(self):
+        return len(self.lines())
+
+
+    def __getitem__(self, i):
+        return self.lines()[i]
+
+
+    def __eq__(self, other):
+        return list(self.lines()) == list(other)
+
+
+    def __repr__(self):
+        return 'RecordView({0}, {1})'.format(self.start, self.end)
+
+
+class PnrDump(object):
+    """
+    Memory-mapped PNR dump file.
+
+    Record boundaries are found by searching the `****End of PNR Key`
+    marker in the raw bytes, nothing is decoded here.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = open(filename, mode = "rb")
+        try:
+            self.buf = mmap.mmap(self.fh.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can not be mapped
+            self.buf = b''
+
+        self.size = len(self.buf)
+        self._limit = None
+
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.fh.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @property
+    def limit(self):
+        """
+        End of the records part of the dump (the `Total number of PNRs`
+        line, if any). Costs a scan of the whole dump on first call.
+        """
+        if self._limit is None:
+            found = self.buf.find(END_OF_DUMP)
+            self._limit = self.size if found < 0 else line_start(self.buf, found)
+
+        return self._limit
+
+
+    def records(self, start = 0, end = None):
+        """
+        Yields `RecordView` for each record which ends in [start, end).
+
+        `start` must be a record boundary.
+        """
+        buf = self.buf
+        find = buf.find
+        size = self.size
+        end = size if end is None else end
+
+        pos = start
+        while True:
+            marker = find(END_OF_PNR, pos, end)
+            if marker < 0:
+                return
+
+            following = next_line(buf, marker, size)
+            if find(END_OF_DUMP, pos, following) >= 0:
+                return
+
+            yield RecordView(buf, pos, line_start(buf, marker, pos))
+
+            pos = following
+
+
+    def chunks(self, chunk_size, start = 0):
+        """
+        Cut the dump into (start, end) byte ranges of about `chunk_size`
+        bytes each. Ranges are aligned to record boundaries.
+        """
+        buf = self.buf
+        limit = self.limit
+
+        ranges = []
+        pos = start
+        while pos < limit:
+            marker = buf.find(END_OF_PNR, min(pos + chunk_size, limit), limit)
+            if marker < 0:
+                ranges.append((pos, limit))
+                break
+
+            following = next_line(buf, marker, self.size)
+            ranges.append((pos, following))
+            pos = following
+
+        return ranges
+
+
+def read_pnr_views(filename):
+    """
+    Yields lazily decoded records of `filename`.
+
+    Gives the same records as `read_pnr`, but each of them is a
+    `RecordView` which may be decoded until the generator is exhausted.
+    """
+    with PnrDump(filename) as dump:
+        for view in dump.records():
+            yield view
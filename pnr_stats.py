@@ -0,0 +1,57 @@
+"""
+Counters of the conversion stages: records dropped and time spent
+at each stage.
+
+Each process counts its own. Workers send theirs to the main process
+with the results (`take_stats`) and it adds them up (`add_stats`).
+"""
+
+import collections
+
+
+DROPS = collections.Counter()
+TIMES = collections.Counter()
+
+
+def count_drop(stage):
+    DROPS[stage] += 1
+
+
+def count_time(stage, seconds):
+    TIMES[stage] += seconds
+
+
+def take_stats():
+    """
+    Drops and times counted since the previous call.
+    """
+    stats = (DROPS.copy(), TIMES.copy())
+    DROPS.clear()
+    TIMES.clear()
+
+    return stats
+
+
+def add_stats(stats):
+    drops, times = stats
+    DROPS.update(drops)
+    TIMES.update(times)
+
+
+def format_stats(stats = None):
+    """
+    A table of drops and seconds of each stage, the slowest stage first.
+    Empty if nothing is counted.
+    """
+    drops, times = (DROPS, TIMES) if stats is None else stats
+
+    stages = sorted(set(drops) | set(times), key = lambda stage: -times.get(stage, 0))
+    if not stages:
+        return ''
+
+    lines = ['{0:<28} {1:>10} {2:>10}'.format('stage', 'dropped', 'seconds')]
+    for stage in stages:
+        lines.append('{0:<28} {1:>10} {2:>10.3f}'.format(
+            stage, drops.get(stage, 0), times.get(stage, 0)))
+
+    return '\n'.join(lines)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Conversion of PNR records for use as a library.
+
+`convert` takes records or an open binary dump stream and yields the
+telegram of each PNR or the reason it is rejected, one record at a time.
+Nothing is written to files and logging is not set up: messages go to the
+`pnr_parse` and `pnr_telegram` loggers, handled the way the application
+sets them up.
+
+    for regnum, result in convert(stream, Settings(airline = 'HZ')):
+        if isinstance(result, Rejection):
+            ...
+"""
+
+import io
+
+from pnr_read import read_pnr_stream, record_regnum, has_airline_segment
+from pnr_parse import parse_pnr
+from pnr_cache import parse_cached
+from pnr_telegram import fix_pnr, write_fixed_pnr, log_telegram_exception
+from pnr_types import *
+
+
+class Settings(object):
+    """
+    Conversion settings, the same ones as the `pnr.py` options have.
+
+    `cache`, if any, is a `pnr_cache.ParsedCache`.
+    """
+    def __init__(self, airline = None, current_year = '2014', src_addr = 'HDQRM5N',
+                 dest_addr = 'MOWRM5N', pred_point = None, local_systems = None,
+                 cache = None):
+        if len(src_addr) != 7:
+            raise ValueError('Invalid source airimp address')
+
+        if len(dest_addr) != 7:
+            raise ValueError('Invalid destination airimp address')
+
+        self.airline = airline
+        self.current_year = current_year
+        self.src_addr = src_addr
+        self.dest_addr = dest_addr
+        self.pred_point = pred_point or src_addr[0:3] + src_addr[5:7]
+        self.local_systems = local_systems
+        self.cache = cache
+
+        self.format_ = 'airimp'
+        self.ignored = None
+
+
+def convert_record(record, settings, out):
+    """
+    (regnum, telegram) of `record` or (regnum, `Rejection`) if it is
+    rejected. `out` (`io.StringIO`) is a buffer to reuse.
+
+    Returns None for a PNR which fails to be fixed, the failure is logged
+    like `pnr_telegram.write_pnr` does.
+    """
+    if settings.airline and not has_airline_segment(record, settings.airline):
+        regnum = record_regnum(record)
+        if regnum is not None:
+            return regnum, Rejection('no "{0}" itin'.format(settings.airline))
+
+    try:
+        if settings.cache:
+            pnr = parse_cached(record, settings, parse_pnr)
+        else:
+            pnr = parse_pnr(record, settings)
+    except PnrParseException as e:
+        return record_regnum(record), Rejection(str(e))
+
+    regnum = pnr['regnum']
+
+    try:
+        pnr, text = fix_pnr(pnr, settings)
+    except PnrParseException as e:
+        log_telegram_exception(regnum, e, None)
+        return None
+
+    if not pnr:
+        return regnum, Rejection(text)
+
+    out.seek(0)
+    out.truncate()
+    write_fixed_pnr(pnr, settings, out)
+
+    return regnum, out.getvalue()
+
+
+def convert(source, settings):
+    """
+    Yields (regnum, telegram) or (regnum, `Rejection`) for each record
+    of `source` in order. Nothing is yielded for PNRs which fail to be
+    fixed, the same as `pnr.py` writes nothing for them.
+
+    A record which can not be converted at all (like one with a wrong
+    regnum or date) is rejected with the error, its regnum is None if
+    it is not found, and the conversion goes on.
+
+    `source` is an open binary stream of a dump or an iterable of records,
+    each of them a list of lines (like `pnr_read.read_pnr` gives) or a
+    `pnr_read.RecordView`.
+    """
+    if hasattr(source, 'readline'):
+        source = read_pnr_stream(source)
+
+    out = io.StringIO()
+    for record in source:
+        try:
+            result = convert_record(record, settings, out)
+        except (PnrParseException, ValueError, AssertionError) as e:
+            result = record_regnum(record), Rejection(str(e))
+
+        if result is not None:
+            yield result
@@ -2,12 +2,19 @@
 Module for create airimp telegram from pnr objects and settings.
 """
 
+import io
 import logging
 
 from datetime import datetime
+from time import perf_counter
 
 from pnr_types import *
 from pnr_utils import *
+from pnr_stats import count_drop, count_time
+from pnr_log import kind, failure_kind
+
+
+log = logging.getLogger(__name__)
 
 
 def find_pax(pnr, paxnum):
@@ -36,44 +43,43 @@ def guess_pax(pnr):
 def split_elem(text, head, width = 69, preffix = '///'):
     """
     Split SSR by line `width` with `preffix` on new line.
+
+    Returns a list of lines. A line is cut before the last slash or space
+    which fits, continuation lines start with `head` and `preffix`.
     """
     l = len(text)
     if l < width:
-        return text
+        return [text]
 
     lhead = len(head) + len(preffix)
     if lhead > width / 2:
-        logging.error("invalid ssr head: '{0}'".format(head))
-
-    ind = 0
-    ind_prev = 0
-    dx1 = 0
-    for i in range(l):
-        dx1 = ind
-        dx2 = width + ind
-        if i > 0:
-            dx2 -= lhead
-
-        slash = text.rfind('/', dx1 + lhead, dx2)
-        space = text.rfind(' ', dx1 + lhead, dx2)
-        ind = max(slash, space)
-        if ind == -1:
-            ind = dx2
-        if dx2 > l and (lhead + ind - ind_prev) <= width:
-            ind = dx2
+        log.error("invalid ssr head: '%s'", head, extra = kind('invalid ssr head'))
 
-        # logging.info('i = %d, ind = %d, dx1 = %d, dx2 = %d, text[dx1:dx2]=[%s]' % (i, ind, dx1, dx2, text[dx1:dx2]))
+    rfind = text.rfind
+    line_head = ''
+    lines = []
 
-        if i == 0:
-            res = text[dx1:ind]
-        else:
-            res += '\n' + head + preffix + text[ind_prev:ind]
+    start = 0
+    end = width
+
+    # no more lines than characters even for a broken head
+    for ignore in range(l):
+        ind = max(rfind('/', start + lhead, end), rfind(' ', start + lhead, end))
+        if ind == -1:
+            ind = end
+        if end > l and (lhead + ind - start) <= width:
+            ind = end
 
-        ind_prev = ind
-        if dx2 > l:
+        lines.append(line_head + text[start:ind])
+        line_head = head + preffix
+
+        if end > l:
             break
 
-    return res
+        start = ind
+        end = width + ind - lhead
+
+    return lines
 
 
 def output_group_name(group, pnr, settings):
@@ -223,7 +229,7 @@ def output_itin(itin, pnr, settings):
     out_append(itin.itin_class)
 
     if itin.depdate:
-        out_append(datetime.strftime(itin.depdate, '%d%b%y').upper())
+        out_append(format_date(itin.depdate))
 
     out_append(' ')
     out_append(itin.deppoint)
@@ -239,8 +245,8 @@ def output_itin(itin, pnr, settings):
         out_append('HK')
 
         if settings.airline == itin.airline:
-            logging.error("Unknown segment status code: "
-                          "'{0}'".format(itin))
+            log.error("Unknown segment status code: '%s'", itin,
+                      extra = kind('unknown segment status code'))
     else:
         out_append(fix_status(itin.status))
 
@@ -358,7 +364,7 @@ def output_ssr(ssr, pnr, settings, need_split = True):
         out_append(make_default(pax))
 
     if need_split == True:
-        return split_elem(''.join(out), head())
+        return '\n'.join(split_elem(''.join(out), head()))
     return ''.join(out)
 
 
@@ -401,7 +407,7 @@ def output_osi(osi, pnr, settings, code_modifier = ''):
         out_append('-')
         out_append(output_pax(pax, pnr, settings))
 
-    return split_elem(''.join(out), head())
+    return '\n'.join(split_elem(''.join(out), head()))
 
 
 def output_remarks(remarks, pnr, settings):
@@ -452,7 +458,7 @@ def output_auxiliary(svc, pnr, settings):
         m = re.search(r'^/.{1}/.{3,15}/.{1,30}/NM-.+/.+/?\s*.+C.+$', t)
 
         if not m:
-            logging.warning('wrong svc text: {0}'.format(t))
+            log.warning('wrong svc text: %s', t, extra = kind('wrong svc text'))
 
 
     def skip():
@@ -478,11 +484,11 @@ def output_auxiliary(svc, pnr, settings):
         out_append(svc.secondary_loc_code)
 
     out_append(' ')
-    out_append(datetime.strftime(svc.service_date, '%d%b%y').upper())
+    out_append(format_date(svc.service_date))
     out_append(' ')
     out_append(svc.text)
 
-    return split_elem(''.join(out), head())
+    return '\n'.join(split_elem(''.join(out), head()))
 
 
 def output_automatic(pnr, settings):
@@ -561,23 +567,7 @@ def fix_group(pnr, settings):
     """
     Add a group ssr to the pnr if it is a group pnr and have no a group ssr.
     """
-    def has_group_ssr():
-        """
-        Check that pnr has no group ssr.
-        """
-        pnr_ssr = pnr['ssr']
-
-        if not pnr_ssr:
-            return False
-
-        for ssr in pnr_ssr:
-            if ssr.code == 'GRPS':
-                return True
-
-        return False
-
-
-    if has_group_ssr():
+    if pnr['ssr'] and ssr_index(pnr).has('GRPS'):
         return pnr, None
 
     pnr_group_name = pnr['group_name']
@@ -596,7 +586,7 @@ def fix_group(pnr, settings):
     if not pnr['ssr']:
         pnr['ssr'] = [ssr]
     else:
-        pnr['ssr'].append(ssr)
+        ssr_index(pnr).append(ssr)
 
 
     return pnr, None
@@ -637,95 +627,160 @@ def fix_responsibility(pnr, settings):
 
 
 def fix_osi(pnr, settings):
-    def remove_osi_from_pnr(o, pnr):
-        """
-        Find and remove osi from pnr osis list.
-        """
-        pnr_osi = pnr['osi']
-        for i, osi in enumerate(pnr_osi):
-            if osi == o:
-                del pnr_osi[i]
-                return
-
+    """
+    Remove infant OSIs of passengers which have an INFT SSR.
+    """
     pnr_osi = pnr['osi']
     pnr_ssr = pnr['ssr']
 
     if not pnr_osi or not pnr_ssr:
         return pnr, None
 
-    osis = [osi for osi in pnr_osi if 'INF ' in osi.text]
-    ssrs = [ssr for ssr in pnr_ssr if ssr.code == 'INFT']
+    infants = ssr_index(pnr).paxnums('INFT')
 
-    if not osis or not ssrs:
+    if not infants:
         return pnr, None
 
-    for osi in osis:
-        if any(ssr for ssr in ssrs if ssr.paxnum == osi.paxnum):
-            remove_osi_from_pnr(osi, pnr)
+    pnr['osi'] = [osi for osi in pnr_osi
+                  if not ('INF ' in osi.text and osi.paxnum in infants)]
 
 
     return pnr, None
 
 
-def fix_ssr(pnr, settings):
-    def tktl_find_pos(ssrs):
-        for i, ssr in enumerate(ssrs):
-            if ssr.code == 'TKTL':
-                return i
+class SsrIndex(object):
+    """
+    Positions of the SSRs of a PNR by code and, within a code, by
+    (paxnum, airline).
 
+    Fixes changing SSRs in place keep it up to date with `replace` and
+    `append`. A new list of SSRs gets a new index (`ssr_index`).
+    """
+    __slots__ = ('ssrs', 'codes')
+
+    def __init__(self, ssrs):
+        self.ssrs = ssrs
+        self.codes = {}
 
-    def tkn_find_pos(ssrs):
         for i, ssr in enumerate(ssrs):
-            if ssr.code.startswith('TKN') and ssr.airline != settings.airline:
-                return i
+            self.add(i, ssr)
 
 
-    def remove_tktl(ssrs):
-        count = len([ssr for ssr in ssrs if ssr.code == 'TKTL'])
+    def add(self, i, ssr):
+        keys = self.codes.get(ssr.code)
+        if keys is None:
+            keys = self.codes[ssr.code] = {}
 
-        while count > 1:
-            i = tktl_find_pos(ssrs)
+        positions = keys.get((ssr.paxnum, ssr.airline))
+        if positions is None:
+            keys[(ssr.paxnum, ssr.airline)] = set([i])
+        else:
+            positions.add(i)
 
-            del ssrs[i]
-            count -= 1
 
+    def discard(self, i, ssr):
+        keys = self.codes[ssr.code]
+        key = (ssr.paxnum, ssr.airline)
 
-    def fix_child(ssrs):
+        keys[key].discard(i)
+        if not keys[key]:
+            del keys[key]
+        if not keys:
+            del self.codes[ssr.code]
+
+
+    def append(self, ssr):
+        self.ssrs.append(ssr)
+        self.add(len(self.ssrs) - 1, ssr)
+
+
+    def replace(self, i, ssr):
+        self.discard(i, self.ssrs[i])
+        self.ssrs[i] = ssr
+        self.add(i, ssr)
+
+
+    def has(self, code):
+        return code in self.codes
+
+
+    def positions(self, *codes):
+        """
+        Positions of SSRs with any of `codes` in order.
+        """
+        return sorted(i for code in codes
+                      for positions in self.codes.get(code, {}).values()
+                      for i in positions)
+
+
+    def paxnums(self, code):
+        return set(paxnum for paxnum, airline in self.codes.get(code, ()))
+
+
+def ssr_index(pnr):
+    """
+    `SsrIndex` of the SSRs of `pnr`, made once for them and shared by
+    the fixes.
+    """
+    index = pnr.ssr_index
+    if index is None or index.ssrs is not pnr['ssr']:
+        index = pnr.ssr_index = SsrIndex(pnr['ssr'])
+
+    return index
+
+
+def fix_ssr(pnr, settings):
+    """
+    Fix SSRs in one pass over the SSRs index, so PNRs with hundreds of
+    ticket SSRs do not cost more than linear time.
+    """
+    def remove_tktl(ssrs, index, removed):
+        """
+        Keep the last TKTL only.
+        """
+        removed.update(index.positions('TKTL')[:-1])
+
+
+    def fix_child(ssrs, index, removed):
         if not settings.airline:
             return
 
-        for i, ssr in enumerate(ssrs):
-            if ssr.code == 'CHLD' and ssr.airline != settings.airline:
-                ssrs[i] = Ssr(code = ssr.code,
-                              airline = settings.airline,
-                              status = ssr.status,
-                              nseats = ssr.nseats,
-                              text = ssr.text,
-                              paxnum = ssr.paxnum)
+        for i in index.positions('CHLD'):
+            ssr = ssrs[i]
+            if ssr.airline != settings.airline:
+                index.replace(i, Ssr(code = ssr.code,
+                                     airline = settings.airline,
+                                     status = ssr.status,
+                                     nseats = ssr.nseats,
+                                     text = ssr.text,
+                                     paxnum = ssr.paxnum))
 
 
-    def fix_tkn(ssrs):
+    def fix_tkn(ssrs, index, removed):
         if not settings.airline:
             return
 
-        tkn = tkn_find_pos(ssrs)
-        while(tkn is not None):
-            ssr_text = output_ssr(ssrs[tkn], pnr, settings, need_split = False)
+        codes = [code for code in index.codes if code.startswith('TKN')]
+
+        for i in index.positions(*codes):
+            ssr = ssrs[i]
+            if ssr.airline == settings.airline:
+                continue
+
+            ssr_text = output_ssr(ssr, pnr, settings, need_split = False)
 
             if not ssr_text:
-                del ssrs[tkn]
+                removed.add(i)
             else:
-                ssrs[tkn] = Ssr(code = 'OTHS',
-                                airline = settings.airline,
-                                status = None,
-                                nseats = None,
-                                text = ssr_text,
-                                paxnum = None)
-
-            tkn = tkn_find_pos(ssrs)
+                index.replace(i, Ssr(code = 'OTHS',
+                                     airline = settings.airline,
+                                     status = None,
+                                     nseats = None,
+                                     text = ssr_text,
+                                     paxnum = None))
 
 
-    def fix_docs(ssrs):
+    def fix_docs(ssrs, index, removed):
         def fix_date_to(text):
             count = 0
             found = text.find('/')
@@ -742,22 +797,24 @@ def fix_ssr(pnr, settings):
             return text
 
 
-        for i, ssr in enumerate(ssrs):
-            if ssr.code == 'DOCS':
-                text = fix_date_to(ssr.text.replace('-', '').replace('+', ''))
+        for i in index.positions('DOCS'):
+            ssr = ssrs[i]
+            text = fix_date_to(ssr.text.replace('-', '').replace('+', ''))
 
-                ssrs[i] = Ssr(code = ssr.code,
-                              airline = ssr.airline,
-                              status = ssr.status,
-                              nseats = ssr.nseats,
-                              text = text,
-                              paxnum = ssr.paxnum)
+            index.replace(i, Ssr(code = ssr.code,
+                                 airline = ssr.airline,
+                                 status = ssr.status,
+                                 nseats = ssr.nseats,
+                                 text = text,
+                                 paxnum = ssr.paxnum))
 
 
     if not 'ssr' in pnr or not pnr['ssr']:
         return pnr, None
 
     ssrs = pnr['ssr']
+    index = ssr_index(pnr)
+    removed = set()
 
     fixes = [
         remove_tktl,
@@ -767,7 +824,10 @@ def fix_ssr(pnr, settings):
     ]
 
     for fix in fixes:
-        fix(ssrs)
+        fix(ssrs, index, removed)
+
+    if removed:
+        pnr['ssr'] = [ssr for i, ssr in enumerate(ssrs) if i not in removed]
 
     return pnr, None
 
@@ -833,71 +893,115 @@ def fix_svc(pnr, settings):
     return pnr, None
 
 
-def fix_pnr(pnr, settings):
+def compile_fixes(fixes):
     """
-    Apply some changes to pnr before processing.
+    Order to run `fixes` in.
+
+    Rejecting fixes go first, so a rejected PNR does not pay for the other
+    fixes nor for parsing the elements only they look at. A fix is moved
+    before the fixes declared earlier only if it does not read what they
+    write and they do not touch what it writes.
     """
-    fixes = [
-        fix_group,
-        fix_responsibility,
-        fix_osi,
-        fix_ssr,
-        fix_svc,
-        fix_not_allowed_airline,
-        fix_pass_name
-    ]
+    early = []
+    late = []
+    reads = set()
+    writes = set()
 
     for fix in fixes:
-        pnr, err = fix(pnr, settings)
+        if fix.rejects and not (set(fix.reads) & writes) and \
+           not (set(fix.writes) & (reads | writes)):
+            early.append(fix)
+        else:
+            late.append(fix)
+            reads.update(fix.reads)
+            writes.update(fix.writes)
+
+    return early + late
+
+
+def fix_pnr(pnr, settings, fixes = None):
+    """
+    Apply some changes to pnr before processing.
+
+    Fixes run in `FIX_ORDER` or, if given, `fixes`. Time of each of them
+    (with parsing of the elements it looks at first) and rejected PNRs are
+    counted in `pnr_stats`.
+    """
+    for fix in FIX_ORDER if fixes is None else fixes:
+        start = perf_counter()
+        pnr, err = fix.fn(pnr, settings)
+        count_time(fix.fn.__name__, perf_counter() - start)
 
         if not pnr:
+            count_drop(fix.fn.__name__)
             return pnr, err
 
     return pnr, None
 
 
-def output_elems(elems, pnr, settings, fn):
+TELEGRAM_SEPARATOR = '+' * 80
+
+
+def log_telegram_exception(regnum, e, key):
+    log.warning("%s\nCreate telegram exception.\nPNR: %s\nException: %s\n"
+                "Called function: %s%s\n\n",
+                TELEGRAM_SEPARATOR, regnum, e, key, TELEGRAM_SEPARATOR,
+                extra = kind(failure_kind(e)))
+
+
+def write_pnr(pnr, settings, out, timer = None):
     """
-    Generic function for output pnr elements like pnr['segment'].
+    Fixes `pnr` and writes its telegram to `out` (`io.StringIO`).
 
-    All output functions get the same parameters.
+    Returns False if the PNR is rejected. The `timer` (`RecordTimer`),
+    if any, gets laps of the fixes and the telegram.
     """
-    if not elems:
-        return None
+    regnum = pnr['regnum']
 
-    out = []
-    out_append = out.append
+    try:
+        pnr, text = fix_pnr(pnr, settings)
+    except PnrParseException as e:
+        log_telegram_exception(regnum, e, None)
+        return True
+    finally:
+        if timer:
+            timer.lap('fix')
 
-    for elem in elems:
-        if not elem:
-            continue
+    if not pnr:
+        if settings.ignored:
+            settings.ignored.write('Regnum: {0} Reason: {1}\n'.format(regnum, text))
+        return False
 
-        r = fn(elem, pnr, settings)
+    write_fixed_pnr(pnr, settings, out)
 
-        if r:
-            out_append(r)
+    if timer:
+        timer.lap('telegram')
 
-    return '\n'.join(out)
+    return True
 
 
-def output_pnr(pnr, settings):
+def write_fixed_pnr(pnr, settings, out):
     """
-    Prints all elements for each pnr data type in fixed order (PNR_OBJS).
+    Writes all elements for each pnr data type in fixed order (PNR_OBJS)
+    to `out` (`io.StringIO`), lines are separated by '\n'.
+
+    If an element can not be output, the elements of its type written so
+    far are cut off and the rest of the telegram is skipped.
     """
-    out = []
+    write = out.write
+    key = None
+    sep = ''
+    mark = out.tell()
 
     try:
 
-        regnum = pnr['regnum']
-        pnr, text = fix_pnr(pnr, settings)
-
-        if not pnr:
-            if settings.ignored:
-                settings.ignored.write('Regnum: {0} Reason: {1}\n'.format(regnum, text))
-            return None
-
-        out_append = out.append
-        [out_append(fn(pnr, settings)) for key, fn in MANUAL_BEFORE if fn]
+        for key, fn in MANUAL_BEFORE:
+            if fn:
+                mark = out.tell()
+                r = fn(pnr, settings)
+                write(sep)
+                write(r)
+                sep = '\n'
 
         for key, fn in PNR_OBJS:
             if not fn:
@@ -906,22 +1010,48 @@ def output_pnr(pnr, settings):
             if key not in pnr:
                 continue
 
-            r = output_elems(pnr[key], pnr, settings, fn)
+            elems = pnr[key]
+            if not elems:
+                continue
+
+            mark = out.tell()
+
+            for elem in elems:
+                if not elem:
+                    continue
+
+                r = fn(elem, pnr, settings)
 
-            if r:
-                out_append(r)
+                if r:
+                    write(sep)
+                    write(r)
+                    sep = '\n'
 
-        [out_append(fn(pnr, settings)) for key, fn in MANUAL_AFTER if fn]
+        for key, fn in MANUAL_AFTER:
+            if fn:
+                mark = out.tell()
+                r = fn(pnr, settings)
+                write(sep)
+                write(r)
+                sep = '\n'
 
     except PnrParseException as e:
-        logging.warning(
-            "{0}\n"
-            "Create telegram exception.\n"
-            "PNR: {1}\nException: {2}\n"
-            "Called function: {4}"
-            "{3}\n\n".format('+' * 80, pnr['regnum'], e, '+' * 80, key))
+        out.seek(mark)
+        out.truncate()
 
-    return '\n'.join(out)
+        log_telegram_exception(pnr['regnum'], e, key)
+
+
+def output_pnr(pnr, settings):
+    """
+    Telegram text of `pnr` or None if the PNR is rejected.
+    """
+    out = io.StringIO()
+
+    if not write_pnr(pnr, settings, out):
+        return None
+
+    return out.getvalue()
 
 
 def make_telegram(pnr, settings):
@@ -979,3 +1109,17 @@ MANUAL_AFTER = [
     ("osi_automatic", output_automatic),
     ("osi_responsibility", output_responsibility),
 ]
+
+
+FIXES = [
+    Fix(fix_group,               reads = ('ssr', 'group_name'),  writes = ('ssr',),                         rejects = False),
+    Fix(fix_responsibility,      reads = ('responsibility',),    writes = ('remote_system', 'remote_pnr'),  rejects = False),
+    Fix(fix_osi,                 reads = ('osi', 'ssr'),         writes = ('osi',),                         rejects = False),
+    Fix(fix_ssr,                 reads = ('ssr', 'name'),        writes = ('ssr',),                         rejects = False),
+    Fix(fix_svc,                 reads = ('auxiliary_service',), writes = ('auxiliary_service',),           rejects = False),
+    Fix(fix_not_allowed_airline, reads = ('segment',),           writes = (),                               rejects = True),
+    Fix(fix_pass_name,           reads = ('name',),              writes = (),                               rejects = True),
+]
+
+
+FIX_ORDER = compile_fixes(FIXES)
@@ -19,5 +19,139 @@ Auxiliary = collections.namedtuple("Auxiliary", "airline status nseats primary_l
 
 CodeFn = collections.namedtuple("CodeFn", ('code', 'fn'))
 
+# fix-up stage: function, PNR keys it reads and writes, whether it rejects PNRs
+Fix = collections.namedtuple("Fix", "fn reads writes rejects")
+
+# reason of a PNR rejected by the conversion
+Rejection = collections.namedtuple("Rejection", "reason")
+
+IndexEntry = collections.namedtuple("IndexEntry", "ordinal offset length regnum digest")
+
+
+# PNR elements in order of their codes (01 - 24, 31)
+PNR_FIELDS = ("update", "group_name", "name", "segment", "group", "contact",
+              "ticket_status", "fare_calculation", "mailing_address",
+              "billing_address", "fares", "auxiliary_service", "ssr", "osi",
+              "remarks", "guest_comments", "fare_box", "tour_code",
+              "original_issue", "ticket_number", "endorsement_information",
+              "form_of_payment", "supplementary_name", "ticketing_data",
+              "responsibility")
+
+PNR_KEYS = ("regnum", "remote_system", "remote_pnr") + PNR_FIELDS
+
+# one value of all absent elements
+EMPTY = ()
+
+
+class Pnr(object):
+    """
+    Parsed PNR.
+
+    Elements are accessed like in a dict: `pnr['ssr']`, `'ssr' in pnr`.
+    Keys are fixed (`PNR_KEYS`), so there is no per-PNR dict and absent
+    elements share the `EMPTY` value instead of an empty list each.
+
+    If `loader` is given, elements are not set at first: an element is
+    got by `loader(key)` on its first access. `materialize` gets all of
+    them and drops the loader.
+
+    `ssr_index` is kept for the fixes (`pnr_telegram.ssr_index`).
+    """
+    __slots__ = PNR_KEYS + ('loader', 'ssr_index')
+
+    def __init__(self, regnum = None, loader = None):
+        self.regnum = regnum
+        self.remote_system = None
+        self.remote_pnr = None
+        self.loader = loader
+        self.ssr_index = None
+
+        if loader is None:
+            for field in PNR_FIELDS:
+                setattr(self, field, EMPTY)
+
+
+    def __getattr__(self, key):
+        """
+        Called for elements which are not set yet only.
+        """
+        if key not in PNR_FIELDS or self.loader is None:
+            raise AttributeError(key)
+
+        value = self.loader(key)
+        setattr(self, key, value)
+
+        return value
+
+
+    def materialize(self):
+        """
+        Load the elements not loaded yet, so the loader (and the raw PNR
+        it keeps) is not needed anymore. Returns the PNR.
+        """
+        if self.loader is not None:
+            for field in PNR_FIELDS:
+                getattr(self, field)
+            self.loader = None
+
+        return self
+
+
+    def __getitem__(self, key):
+        # errors of the loader are not hidden behind a missing key
+        if key not in PNR_KEYS:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+
+    def __setitem__(self, key, value):
+        if key not in PNR_KEYS:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+
+    def __contains__(self, key):
+        return key in PNR_KEYS
+
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def keys(self):
+        return PNR_KEYS
+
+
+    def items(self):
+        self.materialize()
+
+        return [(key, getattr(self, key)) for key in PNR_KEYS]
+
+
+    def __getstate__(self):
+        return self.items()
+
+
+    def __setstate__(self, state):
+        self.loader = None
+        self.ssr_index = None
+        for key, value in state:
+            setattr(self, key, value)
+
+
+    def __eq__(self, other):
+        return isinstance(other, Pnr) and self.items() == other.items()
+
+
+    def __repr__(self):
+        return 'Pnr({0})'.format(', '.join('{0}={1!r}'.format(key, value)
+                                           for key, value in self.items()
+                                           if value is not EMPTY))
+
 ADULT, CHILD, INFANT = range(3)
 MALE, FEMALE = range(2)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
 import re
+import functools
+
+from datetime import date
+
 from pnr_types import *
 
 def logit(fn):
@@ -8,3 +12,48 @@ def logit(fn):
         print('called: {0}'.format(fn.__name__))
         return fn(*args, **kwargs)
     return wrapper
+
+
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+
+MONTH_NUMBERS = dict((name, num) for num, name in enumerate(MONTHS, 1))
+
+
+def is_number(s):
+    """
+    True if `s` has ASCII digits only (`str.isdigit` takes any digits).
+    """
+    return s.isascii() and s.isdigit()
+
+
+def make_date(day, month, year, full_year = False):
+    """
+    Date from `day` (`09`), `month` (`JUN`) and `year` (`14` or, if
+    `full_year`, `2014`).
+
+    Does not depend on locale. Raises ValueError on a wrong date like
+    `datetime.strptime` does.
+    """
+    if len(day) != 2 or not is_number(day) or not is_number(year) or \
+       len(year) != (4 if full_year else 2) or not 1 <= int(day) <= 31:
+        raise ValueError("wrong date: '{0}{1}{2}'".format(day, month, year))
+
+    num = MONTH_NUMBERS.get(month.upper())
+    if num is None:
+        raise ValueError("wrong date: '{0}{1}{2}'".format(day, month, year))
+
+    year = int(year)
+    if not full_year:
+        # the same pivot as `%y`
+        year += 2000 if year < 69 else 1900
+
+    return date(year, num, int(day))
+
+
+@functools.lru_cache(maxsize = 1024)
+def format_date(d):
+    """
+    Format date `d` like `09JUN14` (`%d%b%y` in upper case).
+    """
+    return '{0:02d}{1}{2:02d}'.format(d.day, MONTHS[d.month - 1], d.year % 100)
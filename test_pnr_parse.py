@@ -1,17 +1,45 @@
 #!/usr/bin/env python
 
 
+import csv
+import gzip
+import io
+import logging
+import logging.handlers
+import os
+import pickle
+import random
+import struct
+import tempfile
 import unittest
 # from datetime import datetime
 import datetime
 
-from pnr_read import read_pnr
+from pnr_read import (read_pnr, read_pnr_views, read_pnr_stream, record_regnum,
+                      has_airline_segment, PnrDump)
+from pnr_index import build_index, open_index, load_regnums
+from pnr_delta import load_fingerprints
 from pnr_types import (Itin, Ssr, Pax, Contact, PnrParseException, Responsibility, Osi,
-                       Remarks, Group)
+                       Remarks, Group, Pnr, EMPTY, PNR_KEYS, PNR_FIELDS, Fix, Rejection)
 from pnr_parse import (cut_regnum_from_pax, parse_itin, parse_ssr, parse_pax, parse_pnr,
-                      collect_pnr, parse_osi, parse_remarks, parse_group)
-
-from pnr_telegram import (make_telegram, find_remote_data)
+                      collect_pnr, parse_osi, parse_remarks, parse_group,
+                      parse_itin_grammar, split_itin, parse_raw_pnr, get_depdate)
+from pnr_utils import format_date
+
+from pnr_telegram import (make_telegram, write_pnr, find_remote_data, split_elem, fix_ssr,
+                          fix_osi, fix_pnr, fix_group, ssr_index, compile_fixes,
+                          FIX_ORDER)
+from pnr_stats import format_stats
+from pnr_csv import write_csv, SEGMENT_COLUMNS
+from pnr_columnar import export_pnrs, load_pnrs, read_table, ELEMENT_TABLES
+from pnr_output import open_output
+from pnr_log import SummaryHandler, SummaryFilter, kind, failure_kind
+from pnr_profile import take_slowest, add_slowest, format_slowest
+from pnr_bench import make_synthetic_dump, parse_mix, DEFAULT_MIX
+from pnr_stream import convert, Settings as StreamSettings
+from pnr_cache import ParsedCache, parse_cached, record_key
+
+import pnr
 
 
 RECORD = r"""03   1.HOULE/LANCE M MR T02XL
@@ -35,6 +63,45 @@ RECORD = r"""03   1.HOULE/LANCE M MR T02XL
 31  19.HDQ1S /MOHVEI/8WN4/61734934"""
 
 
+def split_elem_reference(text, head, width = 69, preffix = '///'):
+    """
+    The original `split_elem`, kept to check the new one against it.
+    """
+    l = len(text)
+    if l < width:
+        return text
+
+    lhead = len(head) + len(preffix)
+
+    ind = 0
+    ind_prev = 0
+    dx1 = 0
+    for i in range(l):
+        dx1 = ind
+        dx2 = width + ind
+        if i > 0:
+            dx2 -= lhead
+
+        slash = text.rfind('/', dx1 + lhead, dx2)
+        space = text.rfind(' ', dx1 + lhead, dx2)
+        ind = max(slash, space)
+        if ind == -1:
+            ind = dx2
+        if dx2 > l and (lhead + ind - ind_prev) <= width:
+            ind = dx2
+
+        if i == 0:
+            res = text[dx1:ind]
+        else:
+            res += '\n' + head + preffix + text[ind_prev:ind]
+
+        ind_prev = ind
+        if dx2 > l:
+            break
+
+    return res
+
+
 class Settings:
     def __init__(self):
         self.airline = 'HZ'
@@ -58,6 +125,383 @@ class TestPnrParse(unittest.TestCase):
         self.assertEqual(len([parse_pnr(record, self.settings) for record in read_pnr(filename)]), 12)
 
 
+    def test_read_pnr_views_on_data(self):
+        filename = 'data'
+        self.assertEqual([view.lines() for view in read_pnr_views(filename)],
+                         list(read_pnr(filename)))
+
+
+    def test_read_pnr_views_boundaries(self):
+        DUMP = ("03   1.OX 2.OX VMSKJ\r\n"
+                "04   3.   HZ 782  Y   TU02SEP  OHHUUS HK2   1310 1510\r\n"
+                "\r\n"
+                "****End of PNR Key     VMSKJ\r\n"
+                "****End of PNR Key\r\n"
+                "03   1.HOULE/LANCE M MR T02XL\r\n"
+                "****End of PNR Key     T02XL\r\n"
+                "03   1.TCOI/DENSUN MRS VZJJP\r\n"
+                "Total number of PNRs procesed: 3\r\n"
+                "****End of PNR Key     VZJJP\r\n")
+
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(DUMP.encode('utf-8'))
+
+            views = [list(view) for view in read_pnr_views(filename)]
+            self.assertEqual(views, list(read_pnr(filename)))
+            self.assertEqual(len(views), 3)
+        finally:
+            os.remove(filename)
+
+
+    def test_pnr_dump_chunks(self):
+        filename = 'data'
+        records = list(read_pnr(filename))
+
+        with PnrDump(filename) as dump:
+            for chunk_size in (1, 100, 2000, 10 ** 6):
+                chunks = dump.chunks(chunk_size)
+                self.assertEqual(chunks[0][0], 0)
+                self.assertEqual([view.lines() for start, end in chunks
+                                  for view in dump.records(start, end)],
+                                 records)
+
+
+    def run_pnr(self, *args):
+        """
+        Run pnr.py conversion of `data` and return output and ignored PNRs
+        without the telegram time stamps.
+        """
+        tmpdir = tempfile.mkdtemp()
+        outfile = os.path.join(tmpdir, 'out.txt')
+        ignored = os.path.join(tmpdir, 'ignored.txt')
+        try:
+            settings = pnr.parse_opts(['-i', 'data', '-o', outfile, '-g', ignored] + list(args))
+            if settings.parallel and settings.chunked:
+                pnr.start_chunks(settings.parallel, settings)
+            elif settings.parallel:
+                pnr.start_processes(settings.parallel, settings,
+                                    *pnr.schedule(settings.parallel, settings.batch_size))
+            else:
+                pnr.start_current(settings)
+
+            settings.outfile.close()
+            settings.ignored.close()
+
+            with open(outfile) as out, open(ignored) as ign:
+                return ([l for l in out if not l.startswith('.')], ign.read())
+        finally:
+            for name in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+
+
+    def test_parallel_output_order(self):
+        expected = self.run_pnr('-m', '0', '-a', 'AC')
+
+        self.assertEqual(self.run_pnr('-m', '3', '-b', '1', '-a', 'AC'), expected)
+        self.assertEqual(self.run_pnr('-m', '2', '-b', '5', '-a', 'AC'), expected)
+        self.assertEqual(self.run_pnr('-m', '2', '-c', '-a', 'AC'), expected)
+
+
+    def test_stream_convert(self):
+        expected = self.run_pnr('-m', '0', '-a', 'HZ')
+
+        with open('data', 'rb') as fh:
+            self.assertEqual(list(read_pnr_stream(fh)), list(read_pnr('data')))
+
+        with open('data', 'rb') as fh:
+            sources = [list(convert(fh, StreamSettings(airline = 'HZ')))]
+        for records in (read_pnr('data'), read_pnr_views('data')):
+            sources.append(list(convert(records, StreamSettings(airline = 'HZ'))))
+
+        for results in sources:
+            telegrams = io.StringIO()
+            ignored = io.StringIO()
+            for regnum, result in results:
+                if isinstance(result, Rejection):
+                    ignored.write('Regnum: {0} Reason: {1}\n'.format(regnum, result.reason))
+                else:
+                    self.assertTrue(result.startswith('MOWRM5N'))
+                    telegrams.write(result + '\n\n')
+
+            lines = io.StringIO(telegrams.getvalue()).readlines()
+            self.assertEqual(([l for l in lines if not l.startswith('.')], ignored.getvalue()),
+                             expected)
+
+        self.assertRaises(ValueError, StreamSettings, src_addr = 'HDQ')
+
+        # responsibility fails in `fix_pnr`: logged, neither telegram nor rejection
+        broken = RECORD.replace('31  19.HDQ1S /MOHVEI/8WN4/61734934', '31  19./MOHVEI')
+        records = [broken.split('\n'), self.record]
+        with self.assertLogs('pnr_telegram', 'WARNING') as logs:
+            results = list(convert(records, StreamSettings(airline = 'HZ')))
+        self.assertEqual([regnum for regnum, result in results], ['T02XL'])
+        self.assertIn('Wrong responsibility: /MOHVEI', logs.output[0])
+
+        # records failing to be converted between good ones
+        for failing, error in ((RECORD.replace('TU10JUN', 'TU31JUN'), 'day is out of range'),
+                               (RECORD.replace('MR T02XL', 'MR T02XLL'), 'wrong regnum')):
+            records = [self.record, failing.split('\n'), self.record]
+            results = list(convert(records, StreamSettings(airline = 'HZ')))
+            self.assertEqual(len(results), 3)
+            self.assertIsInstance(results[1][1], Rejection)
+            self.assertIn(error, results[1][1].reason)
+            self.assertEqual([results[0][0], results[2][0]], ['T02XL', 'T02XL'])
+
+        out = io.StringIO()
+        self.assertTrue(write_pnr(parse_pnr(broken.split('\n'), self.settings),
+                                  self.settings, out))
+        self.assertEqual(out.getvalue(), '')
+
+
+    def test_csv_tables(self):
+        self.settings.ignored = io.StringIO()
+        self.settings.ssr_table = io.StringIO()
+        self.settings.osi_table = io.StringIO()
+        out = io.StringIO()
+
+        self.assertTrue(write_csv(parse_pnr(self.record, self.settings), self.settings, out))
+
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(dict(zip(SEGMENT_COLUMNS, rows[1])),
+                         dict(regnum = 'T02XL', paxnum = '1', surname = 'HOULE',
+                              name = 'LANCE M', pax_status = 'MR', group = '0',
+                              airline = 'HZ', flightnum = '9234', itin_class = 'C',
+                              depdate = '2014-06-10', deppoint = 'NRT', arrpoint = 'UUS',
+                              status = 'HK', nseats = '1', deptime = '1630',
+                              arrtime = '2100', text = ''))
+
+        ssrs = list(csv.reader(io.StringIO(self.settings.ssr_table.getvalue())))
+        self.assertEqual(ssrs[0], ['T02XL', 'DOCS', 'HZ', 'HK', '1', '1',
+                                   '/////26MAY59/M//HOULE/LANCE/M'])
+        osis = list(csv.reader(io.StringIO(self.settings.osi_table.getvalue())))
+        self.assertEqual(osis[0], ['T02XL', 'YY', '', 'CARLSON WAGONLIT TRAVEL IATA 60734822'])
+
+        self.settings.airline = 'XX'
+        self.assertFalse(write_csv(parse_pnr(self.record, self.settings), self.settings, out))
+        self.assertEqual(self.settings.ignored.getvalue(), 'Regnum: T02XL Reason: no "XX" itin\n')
+
+
+    def test_columnar_export(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            records = list(read_pnr('data'))
+            self.assertEqual(export_pnrs(records, tmpdir, self.settings, row_group_size = 5),
+                             len(records))
+
+            loaded = load_pnrs(tmpdir)
+            self.assertEqual(len(loaded), len(records))
+
+            for record, pnr in zip(records, loaded):
+                expected = parse_pnr(record, self.settings)
+                self.assertEqual(pnr['regnum'], expected['regnum'])
+                for table, key, type_ in ELEMENT_TABLES:
+                    self.assertEqual(pnr[key], expected[key])
+
+            self.assertEqual(loaded[0]['segment'][0].depdate, datetime.date(2014, 6, 9))
+            self.assertIs(loaded[0]['name'][0].group, False)
+            self.assertEqual(read_table(tmpdir, 'ssr')['code'][:2], ['DOCS', 'TKNE'])
+        finally:
+            for name in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+
+
+    def test_block_output(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for compression in (None, 'gzip'):
+                filename = os.path.join(tmpdir, 'out.{0}'.format(compression))
+                with open_output(filename, compression, block_size = 100) as out:
+                    for i in range(1000):
+                        out.write('Regnum: T{0:04X}\n'.format(i))
+
+                opener = gzip.open if compression else open
+                with opener(filename, 'rt') as fh:
+                    lines = fh.read().split('\n')
+                self.assertEqual(len(lines), 1001)
+                self.assertEqual(lines[999], 'Regnum: T03E7')
+        finally:
+            for name in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+
+        stream = io.TextIOWrapper(io.BytesIO(), encoding = 'utf-8')
+        out = open_output(stream)
+        out.write('MOWRM5N\n')
+        out.close()
+        self.assertFalse(stream.closed)
+        self.assertEqual(stream.buffer.getvalue(), b'MOWRM5N\n')
+
+
+    def test_slowest_records(self):
+        take_slowest()
+        expected = self.run_pnr('-m', '0', '-a', 'AC')
+
+        for args in (('-m', '0'), ('-m', '2', '-b', '1'), ('-m', '2', '-c')):
+            self.assertEqual(self.run_pnr('-P', '3', '-a', 'AC', *args), expected)
+
+            slowest = take_slowest()
+            self.assertEqual(len(slowest), 3)
+            add_slowest(slowest, 2)
+            report = format_slowest()
+            self.assertTrue(report.startswith('1. Regnum: '))
+            self.assertEqual(report.count('Regnum: '), 2)
+            self.assertIn('prefilter', report)
+            take_slowest()
+
+
+    def test_airline_prefilter(self):
+        for record in read_pnr('data'):
+            segments = parse_pnr(record, self.settings)['segment'] or []
+            for airline in ('HZ', 'AC', 'XX'):
+                self.assertEqual(has_airline_segment(record, airline),
+                                 any(itin.airline == airline for itin in segments))
+
+        self.settings.airline = 'AC'
+        self.settings.ignored = io.StringIO()
+        self.assertFalse(pnr.prefilter(self.record[:1] + self.record[2:3], self.settings))
+        self.assertTrue(pnr.prefilter(self.record, self.settings))
+        self.assertEqual(self.settings.ignored.getvalue(),
+                         'Regnum: T02XL Reason: no "AC" itin\n')
+
+
+    def test_log_summary(self):
+        target = logging.handlers.BufferingHandler(100)
+        handler = SummaryHandler(target, 2)
+        logger = logging.getLogger('test_log_summary')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            for i in range(5):
+                try:
+                    parse_ssr('SXR DOCS {0}'.format(i), None, self.settings)
+                except PnrParseException as e:
+                    logger.warning('Exception: %s', e, extra = kind(failure_kind(e)))
+            logger.warning('Unknown regnum: %s', 'T02XL')
+
+            messages = [record.getMessage() for record in target.buffer]
+            self.assertEqual(len(messages), 3)
+            self.assertTrue(messages[1].startswith("Exception: can't parse ssr: 'SXR DOCS 1"))
+            self.assertEqual(messages[2], 'Unknown regnum: T02XL')
+            self.assertEqual(handler.summary(), "Failures:\ncan't parse ssr x5")
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        # the limit applied by the sending process
+        sender = logging.handlers.BufferingHandler(100)
+        summary = SummaryFilter(2)
+        sender.addFilter(summary)
+        logger.addHandler(sender)
+        try:
+            for i in range(5):
+                logger.warning('Exception: %s', i, extra = kind("can't parse ssr"))
+            summary.send_counts(sender)
+            self.assertEqual(len(sender.buffer), 3)
+            self.assertEqual(sender.buffer[2].suppressed, {"can't parse ssr": 3})
+
+            target = logging.handlers.BufferingHandler(100)
+            handler = SummaryHandler(target, 2)
+            for record in sender.buffer:
+                handler.handle(record)
+            self.assertEqual(len(target.buffer), 2)
+            self.assertEqual(handler.summary(), "Failures:\ncan't parse ssr x5")
+        finally:
+            logger.removeHandler(sender)
+
+
+    def test_record_index(self):
+        filename = 'data'
+        records = list(read_pnr(filename))
+        regnums = [parse_pnr(record, self.settings)['regnum'] for record in records]
+
+        self.assertEqual([record_regnum(record) for record in records], regnums)
+
+        tmpdir = tempfile.mkdtemp()
+        index_filename = os.path.join(tmpdir, 'data.idx')
+        try:
+            self.assertEqual(build_index(filename, index_filename), len(records))
+
+            with open_index(filename, index_filename) as index:
+                self.assertEqual(len(index), len(records))
+                self.assertEqual([e.regnum for e in index.entries()], regnums)
+                self.assertEqual(index.by_ordinal(5).lines(), records[5])
+                self.assertEqual(index.by_regnum(regnums[7]).lines(), records[7])
+                self.assertEqual([view.lines() for view in index.records(10)], records[10:])
+                self.assertRaises(KeyError, index.by_regnum, 'XXXXX')
+                self.assertRaises(IndexError, index.by_ordinal, len(records))
+
+            self.assertRaises(SystemExit, pnr.parse_opts, ['-i', filename, '-t', 'XXXXX'])
+
+            ignored = os.path.join(tmpdir, 'ignored.log')
+            with open(ignored, 'w') as fh:
+                fh.write('Regnum: TF26D Reason: no pass name: KO\n'
+                         'Regnum: TF26G Reason: no pass name: KO\n\n'
+                         'TF26D\n')
+            self.assertEqual(load_regnums(ignored), ['TF26D', 'TF26G'])
+        finally:
+            for name in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+
+
+    def test_delta(self):
+        with PnrDump('data') as dump:
+            starts = [view.start for view in dump.records()]
+        with open('data', 'rb') as fh:
+            data = fh.read()
+        raws = [data[start:end] for start, end in zip(starts, starts[1:] + [len(data)])]
+        records = list(read_pnr('data'))
+        regnums = [record_regnum(record) for record in records]
+
+        tmpdir = tempfile.mkdtemp()
+        previous = os.path.join(tmpdir, 'previous')
+        current = os.path.join(tmpdir, 'current')
+        try:
+            with open(previous, 'wb') as fh:
+                fh.write(b''.join(raws[:2] + [raws[2].replace(b'MRS', b'MR')] + raws[3:]))
+            with open(current, 'wb') as fh:
+                fh.write(b''.join(raws[:4] + raws[5:]))
+
+            for args in (('-D', previous), ('-D', previous + '.idx')):
+                settings = pnr.parse_opts(['-i', current, '-o', os.path.join(tmpdir, 'out'),
+                                           '-g', os.path.join(tmpdir, 'ignored'),
+                                           '--deleted-file', os.path.join(tmpdir, 'deleted')]
+                                          + list(args))
+                self.assertEqual([view.lines() for view in pnr.read_records(settings)],
+                                 [records[2]])
+                self.assertEqual(pnr.write_deleted(settings), 1)
+                pnr.close_outputs(settings)
+
+                with open(os.path.join(tmpdir, 'deleted')) as fh:
+                    self.assertEqual(fh.read(), regnums[4] + '\n')
+
+            self.assertEqual(load_fingerprints(current), load_fingerprints(current + '.idx'))
+            self.assertEqual(len(load_fingerprints(current)), len(records) - 1)
+
+            # index of version 1: offset, length, regnum
+            with open(current + '.idx', 'wb') as fh:
+                fh.write(struct.pack('<8sQQQ', b'PNRIDX1\n', 0, 0, 0))
+            fingerprints = load_fingerprints(current + '.idx')
+            self.assertEqual(len(fingerprints), len(records) - 1)
+            self.assertFalse(os.path.exists(current + '.idx.idx'))
+
+            os.remove(current)
+            with open(current + '.idx', 'wb') as fh:
+                fh.write(struct.pack('<8sQQQ', b'PNRIDX1\n', 0, 0, 0))
+            self.assertRaises(ValueError, load_fingerprints, current + '.idx')
+            self.assertRaises(SystemExit, pnr.parse_opts, ['-i', previous, '-D', current + '.idx'])
+            self.assertFalse(os.path.exists(current + '.idx.idx'))
+        finally:
+            for name in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+
+
     def test_cut_regnum_from_pax(self):
         self.assertEqual(cut_regnum_from_pax("ULEZKO/ALINA MRS VZGJZ"),
                          ('ULEZKO/ALINA MRS', 'VZGJZ'))
@@ -94,6 +538,77 @@ class TestPnrParse(unittest.TestCase):
                          Itin(airline='KE', flightnum='658', itin_class='T', depdate=datetime.date(2014, 7, 28), deppoint='BKK', arrpoint='ICN', status='TK', nseats='2', deptime='2345', arrtime='0705+1', text='S'))
 
 
+    def test_parse_itin_fast_path(self):
+        """
+        Column split of segments gives the same as the itin grammar.
+        """
+        texts = ['AC 003  C   MO09JUN  YVRNRT HK    1210 1425+1',
+                 'HZ 9239 Y   WE14MAY14UUSNGK HK12  0900 1030',
+                 'KE 654  T   MO28JUL  BKKICN UN2   2345 0705+1S ET6CT3',
+                 'HZ 802  Y   WE04JUN  BVVUUS UN1   1500 1620  S REQ ALL RES',
+                 'HZ 151  M   WE04JUN  UUSCTS HL1   1300 1220  /5',
+                 'HZ 9234 C   TU10JUN  NRTUUS HK1',
+                 'HZ 9234 C   TU10JUN  NRTUUS HK1   1630',
+                 'HZ 9234 C   TU10JUN  NRTUUS HK1   1630 ABC',
+                 'HZ 9234 C   TU10JUNNRTUUS HK1   1630 2100',
+                 'HZ OPEN Y        UUSCTS',
+                 'ARNK']
+
+        for record in read_pnr('data'):
+            texts.extend(parse_raw_pnr(record)['segment'])
+
+        for text in texts:
+            try:
+                expected = parse_itin_grammar(text, None, self.settings)
+            except (PnrParseException, ValueError) as e:
+                self.assertRaises(type(e), parse_itin, text, None, self.settings)
+                continue
+
+            self.assertEqual(parse_itin(text, None, self.settings), expected)
+
+        self.assertEqual(split_itin('HZ OPEN Y        UUSCTS'), None)
+        self.assertEqual(split_itin('ARNK'), None)
+
+
+    def test_get_depdate(self):
+        """
+        Dates are decoded the same as `datetime.strptime` in C locale does.
+        """
+        strptime = datetime.datetime.strptime
+
+        self.assertEqual(get_depdate('MO09JUN14', self.settings), strptime('09JUN14', '%d%b%y').date())
+        self.assertEqual(get_depdate('10Jul68', self.settings), strptime('10Jul68', '%d%b%y').date())
+        self.assertEqual(get_depdate('10JUL69', self.settings), strptime('10JUL69', '%d%b%y').date())
+        self.assertEqual(get_depdate('MO09JUN', self.settings), datetime.date(2014, 6, 9))
+        self.assertEqual(get_depdate('', self.settings), None)
+
+        for s in ('MO31JUN14', '00JUN14', 'MO9XJUN', '09XXX', '29FEB'):
+            self.assertRaises(ValueError, get_depdate, s, self.settings)
+
+        self.assertRaises(PnrParseException, get_depdate, '9JUN', self.settings)
+
+        d = datetime.date(2014, 6, 9)
+        self.assertEqual(format_date(d), d.strftime('%d%b%y').upper())
+
+
+    def test_split_elem(self):
+        text = 'SSR DOCS HZ HK1 /P/RUS/6402380991/RUS/07JUL72/M/31DEC49/MARCHENKO/YURIY-1MARCHENKO/YURIY'
+        self.assertEqual(split_elem(text, 'SSR DOCS HZ'),
+                         ['SSR DOCS HZ HK1 /P/RUS/6402380991/RUS/07JUL72/M/31DEC49/MARCHENKO',
+                          'SSR DOCS HZ////YURIY-1MARCHENKO/YURIY'])
+        self.assertEqual(split_elem('OSI YY OIN CE23X', 'OSI YY '), ['OSI YY OIN CE23X'])
+
+        rnd = random.Random(2014)
+        for ignore in range(2000):
+            text = ''.join(rnd.choice('AB1/ -') for ignore in range(rnd.randint(0, 300)))
+            head = ''.join(rnd.choice('SR /') for ignore in range(rnd.randint(0, 40)))
+            width = rnd.randint(1, 80)
+            preffix = rnd.choice(('///', '', '/'))
+            self.assertEqual('\n'.join(split_elem(text, head, width, preffix)),
+                             split_elem_reference(text, head, width, preffix),
+                             (text, head, width, preffix))
+
+
     def test_parse_ssr(self):
         self.assertEqual(parse_ssr('SSR OTHS HZ  NN1 UUSDEE 0799T11OCT.TKSTTREBOVANIE VPDFSB0560002459118.TOLKO NA REYSAKHHZ/P1', None, self.settings),
                          Ssr(code='OTHS', airline='HZ', status='NN', nseats='1', text='UUSDEE 0799T11OCT.TKSTTREBOVANIE VPDFSB0560002459118.TOLKO NA REYSAKHHZ', paxnum='1'))
@@ -178,6 +693,82 @@ class TestPnrParse(unittest.TestCase):
                          Group(total='23', name='SOTSPODDERZHKA', named='0'))
 
 
+    def test_pnr_container(self):
+        pnr = parse_pnr(self.record, self.settings)
+
+        self.assertTrue(isinstance(pnr, Pnr))
+        self.assertEqual(pnr['regnum'], 'T02XL')
+        self.assertEqual(len(pnr['segment']), 4)
+        self.assertTrue(pnr['fares'] is EMPTY)
+        self.assertEqual(pnr['group_name'], None)
+        self.assertEqual(pnr.get('remote_pnr'), None)
+        self.assertEqual(list(pnr.keys()), list(PNR_KEYS))
+        self.assertTrue('ssr' in pnr)
+        self.assertFalse('unknown' in pnr)
+        self.assertRaises(KeyError, lambda: pnr['unknown'])
+        self.assertFalse(hasattr(pnr, '__dict__'))
+
+        pnr['remote_pnr'] = 'MOHVEI'
+        self.assertEqual(pnr['remote_pnr'], 'MOHVEI')
+        self.assertRaises(KeyError, pnr.__setitem__, 'unknown', 1)
+        self.assertNotEqual(pnr, parse_pnr(self.record, self.settings))
+
+
+    def test_lazy_pnr(self):
+        pnr = parse_pnr(self.record, self.settings)
+        self.assertRaises(AttributeError, Pnr.ssr.__get__, pnr)
+        self.assertEqual(len(pnr['ssr']), 3)
+        self.assertEqual(len(Pnr.ssr.__get__(pnr)), 3)
+
+        self.assertIs(pnr.materialize(), pnr)
+        self.assertIs(pnr.loader, None)
+        self.assertEqual(pickle.loads(pickle.dumps(pnr)), pnr)
+        self.assertEqual(pickle.loads(pickle.dumps(parse_pnr(self.record, self.settings))), pnr)
+
+        def broken(key):
+            raise TypeError('broken loader')
+
+        pnr = Pnr('T02XL', loader = broken)
+        self.assertRaises(TypeError, pnr.__getitem__, 'ssr')
+        self.assertRaises(TypeError, pnr.get, 'ssr')
+        self.assertRaises(KeyError, pnr.__getitem__, 'unknown')
+        self.assertEqual(pnr.get('unknown', 1), 1)
+
+        self.settings.airline = 'XX'
+        pnr = parse_pnr(self.record, self.settings)
+        self.assertEqual(make_telegram(pnr, self.settings), None)
+        self.assertRaises(AttributeError, Pnr.ssr.__get__, pnr)
+        self.assertRaises(AttributeError, Pnr.remarks.__get__, pnr)
+
+
+    def test_parsed_cache(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.settings.cache = ParsedCache(filename)
+            pnr = parse_cached(self.record, self.settings, parse_pnr)
+            self.settings.cache.close()
+
+            def fail(record, settings):
+                raise AssertionError('parsed again')
+
+            cached = parse_cached(self.record, self.settings, fail)
+            self.assertEqual(cached, pnr)
+            telegrams = [make_telegram(p, self.settings).split('\n')
+                         for p in (cached, parse_pnr(self.record, self.settings))]
+            self.assertEqual([l for l in telegrams[0] if not l.startswith('.')],
+                             [l for l in telegrams[1] if not l.startswith('.')])
+            self.assertNotEqual(record_key(self.record, '2014'), record_key(self.record, '2015'))
+
+            self.assertEqual(self.settings.cache.prune(10 ** 6), 0)
+            self.assertEqual(self.settings.cache.prune(0), 1)
+            self.settings.cache.close()
+        finally:
+            for name in (filename, filename + '-wal', filename + '-shm'):
+                if os.path.exists(name):
+                    os.remove(name)
+
+
     def test_make_telegram(self):
         pnr = parse_pnr(self.record, self.settings)
         telegram = make_telegram(pnr, self.settings)
@@ -212,6 +803,29 @@ OSI YY 23 POS/HDQ1S /MOHVEI/8WN4/61734934""".split('\n')
         self.assertEqual(t[2:], T[2:])
 
 
+    def test_make_telegram_cut_on_error(self):
+        PNR = """03   1.HOULE/LANCE M MR T02XL
+04   2.   AC 003  C   MO09JUN  YVRNRT HK    1210 1425+1
+04   3.   HZ 9234 C   TU10JUN  NRTUUS HK1   1630 2100
+13   4.SSR DOCS HZ  HK1 /////26MAY59/M//HOULE/LANCE/M/P1
+13   5.SSR PSPT HZ  HK1 /P/RU/P1
+14   6.OSI YY  OIN CE23X
+31   7.HDQ1S /MOHVEI/8WN4/61734934"""
+
+        pnr = parse_pnr(PNR.split('\n'), self.settings)
+        t = make_telegram(pnr, self.settings).split('\n')
+
+        self.assertEqual(t[2:], ['HDQ1S MOHVEI',
+                                 '1HOULE/LANCE M MR',
+                                 'AC0003C09JUN14 YVRNRT HK1/1210 1425/1',
+                                 'HZ9234C10JUN14 NRTUUS HK1/1630 2100'])
+
+        out = io.StringIO()
+        out.write('TELEGRAM\n\n')
+        self.assertTrue(write_pnr(parse_pnr(PNR.split('\n'), self.settings), self.settings, out))
+        self.assertEqual(out.getvalue().split('\n')[4:], t[2:])
+
+
     def test_group_pnr(self):
         GROUP_PNR = """02   0.14SOTSPODDERZHKA/GRP NM0 VSG5F
 04   1.   HZ 802  Y   FR26SEP  BVVUUS HK14  1500 1620
@@ -238,6 +852,12 @@ OSI YY 23 POS/UUS005//UUS/HZ/A/RU""".split('\n')
         self.assertEqual(t[1][:9], T[1][:9]) # datetime changes every time.
         self.assertEqual(t[2:], T[2:])
 
+        raw_pnr = parse_raw_pnr(GROUP_PNR.replace('NM0', 'NM1').replace(
+            '04   1.', '03   7.IVANOV/IVAN MR\n04   1.').split('\n'))
+        pnr = collect_pnr(raw_pnr, self.settings)
+        self.assertEqual([pax.group for pax in pnr['name']], [True])
+        self.assertEqual(sorted(raw_pnr), sorted(PNR_FIELDS + ('regnum',)))
+
 
     def test_find_remote_system_pnr(self):
         text = r'MOW1H /N3PG3K/08HBR/KHBRE40/TKP08KHBR0059'
@@ -602,6 +1222,93 @@ OSI YY 23 POS/SPK001//SPK/HZ/A/JP""".split('\n')
         self.assertEqual(t[2:], T[2:])
 
 
+    def test_compile_fixes(self):
+        fixes = [Fix('a', reads = ('ssr',), writes = ('ssr',), rejects = False),
+                 Fix('b', reads = ('ssr',), writes = (), rejects = True),
+                 Fix('c', reads = ('osi',), writes = ('osi',), rejects = False),
+                 Fix('d', reads = ('name',), writes = (), rejects = True),
+                 Fix('e', reads = ('name',), writes = ('osi',), rejects = True)]
+
+        self.assertEqual([fix.fn for fix in compile_fixes(fixes)], ['d', 'a', 'b', 'c', 'e'])
+        self.assertEqual([fix.fn.__name__ for fix in FIX_ORDER[:2]],
+                         ['fix_not_allowed_airline', 'fix_pass_name'])
+
+        self.settings.airline = 'XX'
+        pnr = parse_pnr(self.record, self.settings)
+        self.assertEqual(fix_pnr(pnr, self.settings, []), (pnr, None))
+        self.assertEqual(fix_pnr(pnr, self.settings)[0], None)
+
+        self.assertEqual(format_stats(({}, {})), '')
+        self.assertEqual(format_stats(({'fix_pass_name': 2}, {'fix_ssr': 1.5})).split('\n')[1:],
+                         ['fix_ssr                               0      1.500',
+                          'fix_pass_name                         2      0.000'])
+
+
+    def test_fix_large_group(self):
+        """
+        SSR fixes of a group with many tickets.
+        """
+        count = 300
+        pnr = Pnr('T02XL')
+        pnr['name'] = [Pax(name = 'A', surname = 'P{0}'.format(i), status = None,
+                           nseats = 1, group = True) for i in range(count)]
+        pnr['ssr'] = [Ssr(code = code, airline = airline, status = 'HK', nseats = '1',
+                          text = 'UUSCTS0151K25OCT.598240107491{0}C1'.format(i),
+                          paxnum = str(i % 99 + 1))
+                      for i in range(count) for code, airline in (('TKTL', 'HZ'),
+                                                                  ('TKNE', 'JL'),
+                                                                  ('INFT', 'HZ'))]
+        pnr['osi'] = [Osi(airline = 'YY', text = 'INF P{0}'.format(i), paxnum = str(i + 90))
+                      for i in range(20)]
+
+        pnr, err = fix_ssr(pnr, self.settings)
+        ssrs = pnr['ssr']
+
+        self.assertEqual(len(ssrs), count * 2 + 1)
+        self.assertEqual([ssr.code for ssr in ssrs[:4]], ['OTHS', 'INFT', 'OTHS', 'INFT'])
+        self.assertEqual([ssr.code for ssr in ssrs[-3:]], ['TKTL', 'OTHS', 'INFT'])
+        self.assertEqual(ssrs[-3].text, 'UUSCTS0151K25OCT.598240107491{0}C1'.format(count - 1))
+        self.assertTrue(ssrs[0].text.startswith('SSR TKNE JL HK1 UUSCTS0151K25OCT-1P0/A'))
+
+        pnr, err = fix_osi(pnr, self.settings)
+        self.assertEqual([osi.paxnum for osi in pnr['osi']], [str(i) for i in range(100, 110)])
+
+        pnr['group_name'] = [Group(total = count, name = 'P', named = count)]
+        pnr, err = fix_group(pnr, self.settings)
+        index = ssr_index(pnr)
+        self.assertIs(index.ssrs, pnr['ssr'])
+        self.assertTrue(index.has('GRPS'))
+        for code in ('OTHS', 'INFT', 'TKTL', 'GRPS'):
+            self.assertEqual(index.positions(code),
+                             [i for i, ssr in enumerate(pnr['ssr']) if ssr.code == code])
+        self.assertEqual(index.paxnums('INFT'), set(str(i % 99 + 1) for i in range(count)))
+
+
+    def test_synthetic_dump(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            count = make_synthetic_dump(filename, 2 ** 16, parse_mix(DEFAULT_MIX))
+            records = list(read_pnr(filename))
+            self.assertEqual(len(records), count)
+
+            kinds = set()
+            for num, record in enumerate(records):
+                pnr = parse_pnr(record, self.settings)
+                self.assertEqual(pnr['regnum'], 'T{0:04X}'.format(num))
+                kinds.add(bool(pnr['group_name']))
+
+                out = io.StringIO()
+                if write_pnr(pnr, self.settings, out):
+                    self.assertTrue(out.getvalue())
+
+            self.assertEqual(kinds, {True, False})
+        finally:
+            os.remove(filename)
+
+        self.assertRaises(ValueError, parse_mix, 'single=1,huge=2')
+
+
     def test_tkn_asterisk(self):
         """
         Move SSR TKN* to SSR OTHS.